@@ -2,12 +2,14 @@ import logging
 import sys
 import argparse
 from os import path
-from plaza_preprocessing.importer import importer
-from plaza_preprocessing.merger import merger
-from plaza_preprocessing.optimizer import optimizer, shortest_paths
+from plaza_preprocessing.importer import importer, importcache, changes
+from plaza_preprocessing.merger import merger, plazatransformer
+from plaza_preprocessing.optimizer import optimizer, shortest_paths, plazastate
+from plaza_preprocessing.optimizer.resultcache import PlazaResultCache
 from plaza_preprocessing.optimizer.graphprocessor.graphprocessor import GraphProcessor
 from plaza_preprocessing.optimizer.graphprocessor.visibilitygraph import VisibilityGraphProcessor
 from plaza_preprocessing.optimizer.graphprocessor.spiderwebgraph import SpiderWebGraphProcessor
+from plaza_preprocessing.optimizer.graphprocessor.sweepvisibilitygraph import SweepVisibilityGraphProcessor
 from plaza_preprocessing import configuration
 
 logger = logging.getLogger('plaza_preprocessing')
@@ -15,21 +17,65 @@ logger = logging.getLogger('plaza_preprocessing')
 
 def plaza_preprocessing():
     """entry point"""
-    source, destination, config_file, verbose_log = parse_args(sys.argv[1:])
-
-    setup_logging(verbose=verbose_log)
-    config = configuration.load_config(config_file)
-    preprocess_osm(source, destination, config)
-
-
-def preprocess_osm(osm_filename: str, out_file: str, config: dict):
+    args = parse_args(sys.argv[1:])
+
+    setup_logging(verbose=args.v)
+    config = configuration.load_config(args.config)
+    preprocess_osm(args.source, args.destination, config, workers=args.workers, low_memory=args.low_memory,
+                   cache_dir=args.cache_dir, state_file=args.state, change_file=args.reprocess_changes,
+                   previous_output=args.previous_output, result_cache_dir=args.result_cache,
+                   result_cache_size_mb=args.result_cache_size, location_index_type=args.location_index,
+                   location_index_file=args.location_index_file)
+
+
+def preprocess_osm(osm_filename: str, out_file: str, config: dict, workers=1, low_memory=False, cache_dir=None,
+                   state_file=None, change_file=None, previous_output=None, result_cache_dir=None,
+                   result_cache_size_mb=1024, location_index_type=None, location_index_file=None):
+    """
+    process the plazas of an OSM file and merge them into out_file.
+    With a state file, the results of all plazas are saved. With a change file and the output of the
+    previous run, only the plazas affected by the changes are processed and the others are taken from the state.
+    out_file is always written completely
+    With a result cache directory, the results of single plazas are cached across runs.
+    The location index type and file override the ones of the config
+    """
     shortest_path_strategy = _get_shortest_path_strategy(config)
     process_strategy = _get_process_strategy(config)
     logger.info(f"Using {config['graph-strategy']} graph with {config['shortest-path-algorithm']} algorithm")
-    osm_holder = importer.import_osm(osm_filename, config['tag-filter'])
-
-    processed_plazas = optimizer.preprocess_plazas(osm_holder, process_strategy, shortest_path_strategy, config)
-    merger.merge_plaza_graphs(processed_plazas, osm_filename, out_file, config['footway-tags'])
+    location_index = importer.location_index(
+        location_index_type or config.get('location-index', importer.DEFAULT_LOCATION_INDEX),
+        location_index_file or config.get('location-index-file'))
+    if cache_dir:
+        osm_holder = importcache.import_osm_cached(
+            osm_filename, config['tag-filter'], cache_dir, low_memory=low_memory, location_index=location_index)
+    else:
+        osm_holder = importer.import_osm(
+            osm_filename, config['tag-filter'], low_memory=low_memory, location_index=location_index)
+    result_cache = None
+    if result_cache_dir:
+        result_cache = PlazaResultCache(result_cache_dir, result_cache_size_mb * 1024 * 1024)
+
+    if state_file:
+        previous_results = {}
+        changed_bounds = []
+        if change_file:
+            logger.info(f"Processing plazas affected by {change_file}")
+            previous_results = plazastate.load_state(state_file)
+            changed_ids = changes.read_changes(change_file)
+            changed_bounds = changes.changed_bounds(previous_output, changed_ids, location_index) + \
+                changes.changed_bounds(osm_filename, changed_ids, location_index)
+        plaza_results = optimizer.preprocess_changed_plazas(
+            osm_holder, process_strategy, shortest_path_strategy, config, previous_results, changed_bounds,
+            workers=workers, result_cache=result_cache)
+        plazastate.save_state(state_file, plaza_results)
+        processed_plazas = [plaza for plaza in plaza_results.values() if plaza is not None]
+    else:
+        processed_plazas = optimizer.preprocess_plazas(
+            osm_holder, process_strategy, shortest_path_strategy, config, workers=workers, result_cache=result_cache)
+    merger.merge_plaza_graphs(
+        processed_plazas, osm_filename, out_file, config['footway-tags'], lines=osm_holder.lines,
+        location_index=location_index,
+        node_deduplication=config.get('node-deduplication', plazatransformer.DEFAULT_NODE_DEDUPLICATION))
 
 
 def setup_logging(verbose=False, quiet=False):
@@ -56,6 +102,31 @@ def parse_args(args):
     parser.add_argument('--config', default='plaza_preprocessing_config.yml', metavar="filename",
                         help='specify a config file location. A default config will be created'
                              ' if the path does not exist')
+    parser.add_argument('--workers', default=1, metavar='N', type=_positive_int,
+                        help='number of processes used to process plazas in parallel')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='read the source file twice and only import geometries near plazas')
+    parser.add_argument('--cache-dir', metavar='directory',
+                        help='cache the imported geometries in this directory and reuse them '
+                             'while the source file and the tag filters are unchanged')
+    parser.add_argument('--state', metavar='filename',
+                        help='save the results of all plazas to this file, used to process only changed plazas later')
+    parser.add_argument('--reprocess-changes', metavar='filename', type=_existing_file,
+                        help='OSM change file between the source of the previous run and this source. '
+                             'Only affected plazas are processed again, the destination is still written '
+                             'completely. Requires --state and --previous-output')
+    parser.add_argument('--previous-output', metavar='filename', type=_existing_file,
+                        help='output of the previous run, only read to find what the changes affected')
+    parser.add_argument('--result-cache', metavar='directory',
+                        help='cache the results of single plazas in this directory and reuse them '
+                             'while a plaza, its surroundings and the config are unchanged')
+    parser.add_argument('--result-cache-size', default=1024, metavar='MB', type=_positive_int,
+                        help='maximum size of the result cache, least recently used results are removed')
+    parser.add_argument('--location-index', metavar='type',
+                        choices=configuration.SCHEMA['properties']['location-index']['enum'],
+                        help='how node locations are stored while reading, overrides location-index of the config')
+    parser.add_argument('--location-index-file', metavar='filename',
+                        help='file for the sparse_file_array and dense_file_array location indices')
     parser.add_argument('-v', action='store_true', help='verbose log output')
 
     if len(args) == 0:
@@ -63,7 +134,9 @@ def parse_args(args):
         sys.exit(1)
 
     result = parser.parse_args(args)
-    return result.source, result.destination, result.config, result.v
+    if result.reprocess_changes and not (result.state and result.previous_output):
+        parser.error('--reprocess-changes requires --state and --previous-output')
+    return result
 
 
 def _existing_file(value):
@@ -73,6 +146,17 @@ def _existing_file(value):
     return value
 
 
+def _positive_int(value):
+    """used for argparse to check if the value is a positive integer"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not an integer")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} must be at least 1")
+    return number
+
+
 def _get_process_strategy(config: dict) -> GraphProcessor:
     strategy_config = config['graph-strategy']
     lookup_buffer = config['entry-point-lookup-buffer'] * 2  # max tolerance should be twice the entry point buffer
@@ -81,6 +165,8 @@ def _get_process_strategy(config: dict) -> GraphProcessor:
     elif strategy_config == 'spiderweb':
         spacing = config['spiderweb-grid-size']
         return SpiderWebGraphProcessor(spacing_m=spacing, visibility_delta_m=lookup_buffer)
+    elif strategy_config == 'visibility-sweep':
+        return SweepVisibilityGraphProcessor(visibility_delta_m=lookup_buffer)
     else:
         raise ValueError("invalid value for process strategy")
 
@@ -89,8 +175,14 @@ def _get_shortest_path_strategy(config: dict):
     strategy_config = config['shortest-path-algorithm']
     if strategy_config == 'astar':
         return shortest_paths.compute_astar_shortest_paths
+    elif strategy_config == 'astar-shared':
+        return shortest_paths.compute_shared_astar_shortest_paths
     elif strategy_config == 'dijkstra':
         return shortest_paths.compute_dijkstra_shortest_paths
+    elif strategy_config == 'dijkstra-entry-points':
+        return shortest_paths.compute_entry_point_dijkstra_shortest_paths
+    elif strategy_config == 'dijkstra-sparse':
+        return shortest_paths.compute_sparse_dijkstra_shortest_paths
     else:
         raise ValueError("invalid value for shortest path algorithm")
 
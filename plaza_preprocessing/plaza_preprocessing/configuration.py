@@ -48,13 +48,22 @@ tag-filter:
 footway-tags: # tags that will be used for the newly generated ways
   - highway: footway
 
-graph-strategy: visibility # one of visibility, spiderweb
+graph-strategy: visibility # one of visibility, spiderweb, visibility-sweep
 spiderweb-grid-size: 2 # grid size in meters, if spiderweb is used
 obstacle-buffer: 2 # minimal distance from any obstacles in meters
 
-shortest-path-algorithm: astar # one of astar, dijkstra
+shortest-path-algorithm: astar # one of astar, astar-shared, dijkstra, dijkstra-entry-points, dijkstra-sparse
 
 entry-point-lookup-buffer: 0.05 # tolerance in meters, will be used to detect slightly offset entry points
+
+# how node locations are stored while reading the OSM file, one of sparse_mem_array, sparse_mem_map,
+# sparse_mmap_array, sparse_file_array, dense_mem_array, dense_mmap_array, dense_file_array, flex_mem
+location-index: sparse_mem_array
+# location-index-file: node_locations.idx # file used by sparse_file_array and dense_file_array, must not exist
+
+# exact creates a node for every distinct coordinate pair of the generated ways,
+# osm-precision lets coordinates share a node if they are the same at OSM's precision of 1e-7 degrees
+node-deduplication: exact # one of exact, osm-precision
 """
 
 SCHEMA = {
@@ -89,7 +98,7 @@ SCHEMA = {
        },
        'graph-strategy': {
            'type': 'string',
-           'enum': ['visibility', 'spiderweb']
+           'enum': ['visibility', 'spiderweb', 'visibility-sweep']
        },
        'spiderweb-grid-size': {
            'type': 'number'
@@ -99,10 +108,22 @@ SCHEMA = {
        },
        'shortest-path-algorithm': {
            'type': 'string',
-           'enum': ['astar', 'dijkstra']
+           'enum': ['astar', 'astar-shared', 'dijkstra', 'dijkstra-entry-points', 'dijkstra-sparse']
        },
        'entry-point-lookup-buffer': {
            'type': 'number',
+       },
+       'location-index': {
+           'type': 'string',
+           'enum': ['sparse_mem_array', 'sparse_mem_map', 'sparse_mmap_array', 'sparse_file_array',
+                    'dense_mem_array', 'dense_mmap_array', 'dense_file_array', 'flex_mem']
+       },
+       'location-index-file': {
+           'type': 'string'
+       },
+       'node-deduplication': {
+           'type': 'string',
+           'enum': ['exact', 'osm-precision']
        }
     },
     'additionalProperties': False,
@@ -178,6 +199,18 @@ def create_default_config(config_path: str):
         f.write(DEFAULT_CONFIG)
 
 
+def to_plain_data(data):
+    """
+    copy data loaded by ruamel.yaml into plain dicts and lists.
+    Lookups in ruamel's round trip containers are considerably slower, which adds up when filtering every OSM object
+    """
+    if isinstance(data, dict):
+        return {key: to_plain_data(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [to_plain_data(item) for item in data]
+    return data
+
+
 def filter_tags(tags: dict, tag_filter: dict) -> bool:
     """filter tags based on a tag filter"""
 
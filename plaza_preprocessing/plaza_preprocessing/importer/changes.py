@@ -0,0 +1,111 @@
+"""
+Read OSM change files (.osc) and find the areas they affect.
+A plaza only depends on geometries intersecting its bounds, so it has to be processed again
+if the bounds of a changed object intersect them, before or after the change
+"""
+import logging
+import osmium
+from osmium._osmium import InvalidLocationError
+from plaza_preprocessing.importer.importer import node_bounds, apply_with_locations, DEFAULT_LOCATION_INDEX
+
+logger = logging.getLogger('plaza_preprocessing.importer')
+
+
+class ChangedIds:
+    """ ids of the nodes, ways and relations that were created, modified or deleted """
+    def __init__(self, nodes, ways, relations):
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+
+
+def read_changes(change_file) -> ChangedIds:
+    """ collects the ids of all objects in a change file """
+    collector = _ChangeCollector()
+    collector.apply_file(change_file)
+    logger.debug(f'{len(collector.nodes)} nodes, {len(collector.ways)} ways and '
+                 f'{len(collector.relations)} relations changed in {change_file}')
+    return ChangedIds(collector.nodes, collector.ways, collector.relations)
+
+
+def changed_bounds(filename, changed_ids: ChangedIds, location_index=DEFAULT_LOCATION_INDEX):
+    """
+    returns the bounds of the changed objects in an OSM file. Ways are included if one of their nodes changed,
+    relations with the bounds of their member ways. Changed relation members are changed ways themselves.
+    The file may be the output of a previous run: only ways are read, no areas are assembled from them, and the
+    locations of the generated nodes, which have negative ids, are taken from the file itself
+    """
+    member_ways = _changed_relation_members(filename, changed_ids.relations) if changed_ids.relations else set()
+    handler = _ChangedBoundsHandler(changed_ids, member_ways)
+    apply_with_locations(handler, filename, location_index)
+    logger.debug(f'found {len(handler.bounds)} changed objects in {filename}')
+    return handler.bounds
+
+
+def _changed_relation_members(filename, changed_relations):
+    """ ids of the member ways of the changed relations """
+    collector = _RelationMemberCollector(changed_relations)
+    collector.apply_file(filename)
+    return collector.member_ways
+
+
+class _ChangeCollector(osmium.SimpleHandler):
+    def __init__(self):
+        super().__init__()
+        self.nodes = set()
+        self.ways = set()
+        self.relations = set()
+
+    def node(self, node):
+        self.nodes.add(node.id)
+
+    def way(self, way):
+        self.ways.add(way.id)
+
+    def relation(self, relation):
+        self.relations.add(relation.id)
+
+
+class _RelationMemberCollector(osmium.SimpleHandler):
+    def __init__(self, changed_relations):
+        super().__init__()
+        self.changed_relations = changed_relations
+        self.member_ways = set()
+
+    def relation(self, relation):
+        if relation.id in self.changed_relations:
+            self.member_ways.update(member.ref for member in relation.members if member.type == 'w')
+
+
+class _ChangedBoundsHandler(osmium.SimpleHandler):
+    def __init__(self, changed_ids: ChangedIds, member_ways):
+        super().__init__()
+        self.changed_ids = changed_ids
+        self.member_ways = member_ways
+        # osmium's location index only stores nodes with positive ids
+        self.generated_locations = {}
+        self.bounds = []
+
+    def node(self, node):
+        if node.id < 0 and node.location.valid():
+            self.generated_locations[node.id] = (node.location.lon, node.location.lat)
+        if node.id in self.changed_ids.nodes and node.location.valid():
+            location = node.location
+            self.bounds.append((location.lon, location.lat, location.lon, location.lat))
+
+    def way(self, way):
+        if way.id in self.changed_ids.ways or way.id in self.member_ways or \
+                any(n.ref in self.changed_ids.nodes for n in way.nodes):
+            try:
+                self.bounds.append(self._way_bounds(way))
+            except (InvalidLocationError, KeyError, RuntimeError):
+                logger.debug(f'Could not calculate bounds of changed way {way.id}')
+
+    def _way_bounds(self, way):
+        """ bounds of a way, raises KeyError for generated nodes missing in the file """
+        if not any(n.ref < 0 for n in way.nodes):
+            return node_bounds(way.nodes)
+        locations = [self.generated_locations[n.ref] if n.ref < 0 else (n.lon, n.lat) for n in way.nodes]
+        lons = [lon for lon, _ in locations]
+        lats = [lat for _, lat in locations]
+        return min(lons), min(lats), max(lons), max(lats)
@@ -0,0 +1,57 @@
+"""
+Factories to create shapely geometries from osmium objects.
+Invalid locations raise an InvalidLocationError, invalid geometries a RuntimeError
+"""
+import osmium
+import shapely.wkb as wkblib
+from shapely.geometry import Point, LineString, MultiPolygon
+
+WKBFAB = osmium.geom.WKBFactory()
+
+
+class GeometryFactory:
+    """
+    creates geometries directly from the node locations, without serializing them to WKB first.
+    Like osmium's factories, consecutive nodes at the same location are left out of lines
+    """
+
+    def create_point(self, node):
+        location = node.location
+        return Point(location.lon, location.lat)
+
+    def create_linestring(self, way):
+        coords = []
+        for node in way.nodes:
+            node_coords = (node.lon, node.lat)
+            if not coords or coords[-1] != node_coords:
+                coords.append(node_coords)
+        if len(coords) < 2:
+            raise RuntimeError(f'way {way.id} needs at least two distinct locations for a linestring')
+        return LineString(coords)
+
+    def create_multipolygon(self, area):
+        outer_count, inner_count = area.num_rings()
+        if outer_count == 0:
+            raise RuntimeError(f'area {area.id} has no outer ring')
+        # looking up the inner rings of an outer ring is expensive, most areas don't have any
+        return MultiPolygon([
+            (_ring_coords(outer_ring),
+             [_ring_coords(inner_ring) for inner_ring in area.inner_rings(outer_ring)] if inner_count else [])
+            for outer_ring in area.outer_rings()])
+
+
+def _ring_coords(ring):
+    return [(node.lon, node.lat) for node in ring]
+
+
+class HexWKBGeometryFactory:
+    """ creates all geometries by letting shapely parse the hex WKB created by osmium """
+
+    def create_point(self, node):
+        return wkblib.loads(WKBFAB.create_point(node), hex=True)
+
+    def create_linestring(self, way):
+        return wkblib.loads(WKBFAB.create_linestring(way), hex=True)
+
+    def create_multipolygon(self, area):
+        return wkblib.loads(WKBFAB.create_multipolygon(area), hex=True)
@@ -0,0 +1,161 @@
+"""
+On-disk cache for imported OSM files.
+A cache entry holds the WKB of all imported geometries, their ids and tags, the nodes of the
+lines near plazas and a bulk loaded rtree disk index for the lines, buildings and points. Entries are keyed by
+the hash of the input file and the tag filters, so changing either imports the file again
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from array import array
+from os import path
+import numpy as np
+import rtree
+import shapely.wkb as wkblib
+from plaza_preprocessing.importer import importer
+from plaza_preprocessing.importer.osmholder import OSMHolder
+
+logger = logging.getLogger('plaza_preprocessing.importer')
+
+# increase when the format of the cache entries changes
+CACHE_VERSION = 3
+GEOMETRIES_FILE = 'geometries.npz'
+METADATA_FILE = 'metadata.json'
+INDEX_NAMES = ['lines', 'buildings', 'points']
+
+
+def import_osm_cached(filename, tag_filters, cache_dir, low_memory=False,
+                      location_index=importer.DEFAULT_LOCATION_INDEX):
+    """ returns the holder of an OSM / PBF file from the cache, the file is imported and cached if it's not yet """
+    entry_dir = path.join(cache_dir, cache_key(filename, tag_filters, low_memory))
+    if path.isdir(entry_dir):
+        logger.info(f'loading import of {filename} from cache {entry_dir}')
+        return load_holder(entry_dir)
+
+    holder = importer.import_osm(filename, tag_filters, low_memory=low_memory, location_index=location_index)
+    logger.info(f'storing import of {filename} in cache {entry_dir}')
+    store_holder(holder, entry_dir)
+    holder.spatial_index_dir = entry_dir
+    return holder
+
+
+def cache_key(filename, tag_filters, low_memory=False):
+    """ hash of the file content and everything else that changes the result of the import """
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as osm_file:
+        for chunk in iter(lambda: osm_file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    settings = {'version': CACHE_VERSION, 'tag-filter': tag_filters, 'low-memory': low_memory}
+    file_hash.update(json.dumps(settings, sort_keys=True).encode())
+    return file_hash.hexdigest()
+
+
+def store_holder(holder: OSMHolder, entry_dir):
+    """
+    store the holder in a new cache entry.
+    The entry is written to a temporary directory first, so incomplete entries are never read
+    """
+    cache_dir = path.dirname(entry_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.incomplete-')
+    try:
+        plaza_geometries = [plaza['geometry'] for plaza in holder.plazas]
+        line_geometries = [line['geometry'] for line in holder.lines]
+        np.savez(path.join(temp_dir, GEOMETRIES_FILE),
+                 **_to_wkb_arrays('plazas', plaza_geometries),
+                 **_to_wkb_arrays('buildings', holder.buildings),
+                 **_to_wkb_arrays('lines', line_geometries),
+                 **_to_wkb_arrays('points', holder.points),
+                 **_to_node_arrays([line for line in holder.lines if 'node_refs' in line]))
+
+        metadata = {
+            'plazas': [plaza['osm_id'] for plaza in holder.plazas],
+            'lines': [{'id': line['id'], 'tags': line['tags'], 'version': line['version'],
+                       'nodes': 'node_refs' in line} for line in holder.lines]
+        }
+        with open(path.join(temp_dir, METADATA_FILE), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+        for name, geometries in zip(INDEX_NAMES, [line_geometries, holder.buildings, holder.points]):
+            _create_disk_index(path.join(temp_dir, name), geometries)
+
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        if path.isdir(entry_dir):
+            # another run stored the same entry in the meantime
+            shutil.rmtree(temp_dir)
+        else:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+
+def load_holder(entry_dir) -> OSMHolder:
+    """ load a holder from a cache entry, its spatial indices are read from the rtree disk index """
+    with np.load(path.join(entry_dir, GEOMETRIES_FILE)) as arrays:
+        plaza_geometries = _from_wkb_arrays('plazas', arrays)
+        buildings = _from_wkb_arrays('buildings', arrays)
+        line_geometries = _from_wkb_arrays('lines', arrays)
+        points = _from_wkb_arrays('points', arrays)
+        line_nodes = _from_node_arrays(arrays)
+    with open(path.join(entry_dir, METADATA_FILE)) as metadata_file:
+        metadata = json.load(metadata_file)
+
+    plazas = [{'osm_id': osm_id, 'geometry': geometry}
+              for osm_id, geometry in zip(metadata['plazas'], plaza_geometries)]
+    lines = [{'id': line['id'], 'geometry': geometry, 'tags': line['tags'], 'version': line['version']}
+             for line, geometry in zip(metadata['lines'], line_geometries)]
+    lines_with_nodes = [line for line, line_metadata in zip(lines, metadata['lines']) if line_metadata['nodes']]
+    for line, (node_refs, node_coords) in zip(lines_with_nodes, line_nodes):
+        line['node_refs'] = node_refs
+        line['node_coords'] = node_coords
+    logger.debug(f'loaded {len(plazas)} plazas, {len(buildings)} buildings, {len(lines)} lines '
+                 f'and {len(points)} points from cache')
+    return OSMHolder(plazas, buildings, lines, points, spatial_index_dir=entry_dir)
+
+
+def _to_wkb_arrays(name, geometries):
+    """ the concatenated WKB of all geometries and the offsets where each of them ends """
+    wkbs = [geometry.wkb for geometry in geometries]
+    return {
+        f'{name}_wkb': np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+        f'{name}_offsets': np.cumsum([len(wkb) for wkb in wkbs], dtype=np.int64)
+    }
+
+
+def _from_wkb_arrays(name, arrays):
+    data = arrays[f'{name}_wkb'].tobytes()
+    ends = arrays[f'{name}_offsets'].tolist()
+    starts = [0] + ends[:-1]
+    return [wkblib.loads(data[start:end]) for start, end in zip(starts, ends)]
+
+
+def _to_node_arrays(lines):
+    """ the concatenated node refs and coordinates of all lines and the offsets where the refs of each of them end """
+    return {
+        'line_node_refs': np.concatenate([np.array([], dtype=np.int64)] +
+                                         [np.frombuffer(line['node_refs'], dtype=np.int64) for line in lines]),
+        'line_node_coords': np.concatenate([np.array([], dtype=np.float64)] +
+                                           [np.frombuffer(line['node_coords'], dtype=np.float64) for line in lines]),
+        'line_node_offsets': np.cumsum([len(line['node_refs']) for line in lines], dtype=np.int64)
+    }
+
+
+def _from_node_arrays(arrays):
+    refs = arrays['line_node_refs']
+    coords = arrays['line_node_coords']
+    ends = arrays['line_node_offsets'].tolist()
+    starts = [0] + ends[:-1]
+    return [(array('q', refs[start:end].tobytes()), array('d', coords[2 * start:2 * end].tobytes()))
+            for start, end in zip(starts, ends)]
+
+
+def _create_disk_index(index_path, geometries):
+    """ create a bulk loaded rtree index stored in index_path.dat and index_path.idx """
+    if not geometries:
+        rtree.index.Index(index_path).close()
+        return
+    index = rtree.index.Index(index_path, ((i, geometry.bounds, None) for i, geometry in enumerate(geometries)))
+    index.close()
@@ -1,22 +1,35 @@
 import logging
+import os
+from array import array
+from os import path
 import osmium
+import rtree
 from osmium._osmium import InvalidLocationError
-import shapely.wkb as wkblib
 from plaza_preprocessing.importer import osmholder
+from plaza_preprocessing.importer.geometryfactory import GeometryFactory
 from plaza_preprocessing import configuration
 
 logger = logging.getLogger('plaza_preprocessing.importer')
-WKBFAB = osmium.geom.WKBFactory()
 
+DEFAULT_LOCATION_INDEX = 'sparse_mem_array'
+# index types storing the node locations in a file instead of memory
+FILE_LOCATION_INDICES = ['sparse_file_array', 'dense_file_array']
 
-def import_osm(filename, tag_filters):
+
+def import_osm(filename, tag_filters, low_memory=False, location_index=DEFAULT_LOCATION_INDEX):
     """ imports a OSM / PBF file and returns a holder with all plazas, buildings,
-    lines and points with shapely geometries """
+    lines and points with shapely geometries.
+    In low memory mode, the file is read twice and only geometries near a plaza are kept.
+    location_index is the osmium index of the node locations, see location_index """
     logger.info(f'importing {filename}')
-    handler = _PlazaHandler(tag_filters)
 
-    index_type = 'sparse_mem_array'
-    handler.apply_file(filename, locations=True, idx=index_type)
+    plaza_index = None
+    if low_memory:
+        plaza_index = _create_plaza_index(filename, tag_filters, location_index)
+
+    handler = _PlazaHandler(tag_filters, plaza_index)
+    apply_with_locations(handler, filename, location_index)
+    handler.add_line_nodes(plaza_index or _plaza_bounds_index(handler.plazas))
 
     logger.debug(f'found {len(handler.plazas)} plazas')
     logger.debug(f'found {len(handler.buildings)} buildings')
@@ -28,31 +41,150 @@ def import_osm(filename, tag_filters):
     return osmholder.OSMHolder(handler.plazas, handler.buildings, handler.lines, handler.points)
 
 
-class _PlazaHandler(osmium.SimpleHandler):
-    def __init__(self, tag_filters):
+def location_index(index_type=DEFAULT_LOCATION_INDEX, index_file=None):
+    """
+    osmium index for the node locations, file backed index types store the locations in index_file.
+    index_file must not exist, it is created for every read and removed afterwards
+    """
+    if index_type in FILE_LOCATION_INDICES:
+        if not index_file:
+            raise ValueError(f'location index {index_type} requires a file')
+        return f'{index_type},{index_file}'
+    return index_type
+
+
+def apply_with_locations(handler, filename, index=DEFAULT_LOCATION_INDEX):
+    """
+    apply the handler to a file with node locations.
+    The file of a file backed index must not exist, osmium would add the locations to its content.
+    It is created for this read and removed afterwards
+    """
+    index_file = index.partition(',')[2]
+    if index_file and path.exists(index_file):
+        raise FileExistsError(f'location index file {index_file} already exists')
+    logger.debug(f'reading {filename} with location index {index}')
+    try:
+        handler.apply_file(filename, locations=True, idx=index)
+    finally:
+        if index_file and path.exists(index_file):
+            os.remove(index_file)
+
+
+def _create_plaza_index(filename, tag_filters, location_index):
+    """
+    collect the plazas in a first pass and create a rtree index with their bounds.
+    The optimizer only looks at geometries that intersect the bounds of a plaza,
+    so everything outside of them can be dropped while importing
+    """
+    logger.debug('collecting plaza bounds for low memory import')
+    collector = _PlazaCollector(tag_filters)
+    apply_with_locations(collector, filename, location_index)
+    return _plaza_bounds_index(collector.plazas)
+
+
+def _plaza_bounds_index(plazas):
+    """ rtree index with the bounds of the plazas """
+    plaza_index = rtree.index.Index()
+    for i, plaza in enumerate(plazas):
+        plaza_index.insert(i, plaza['geometry'].bounds)
+    logger.debug(f'indexed bounds of {len(plazas)} plazas')
+    return plaza_index
+
+
+def node_bounds(nodes):
+    """ bounds of a list of node references, raises InvalidLocationError for missing locations """
+    if len(nodes) == 0:
+        raise RuntimeError('no nodes to calculate bounds')
+    lons = [n.lon for n in nodes]
+    lats = [n.lat for n in nodes]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+class _PlazaCollector(osmium.SimpleHandler):
+    """ collects plazas only """
+    def __init__(self, tag_filters, geometry_factory=None):
         super().__init__()
-        self.tag_filters = tag_filters
+        self.tag_filters = configuration.to_plain_data(tag_filters)
+        self.geometry_factory = geometry_factory or GeometryFactory()
         self.plazas = []
+        self.invalid_count = 0
+
+    def area(self, area):
+        if self._is_plaza(area):
+            self._add_plaza(area)
+
+    def _add_plaza(self, area):
+        multipolygon_geom = self._create_multipolygon(area)
+        if multipolygon_geom:
+            for polygon in multipolygon_geom.geoms:
+                plaza = {
+                    'osm_id': area.orig_id(),
+                    'geometry': polygon
+                }
+                self.plazas.append(plaza)
+
+    def _create_multipolygon(self, area):
+        try:
+            return self.geometry_factory.create_multipolygon(area)
+
+        except InvalidLocationError:
+            logger.debug(f'Encountered invalid location in area {area.id}')
+            self.invalid_count += 1
+            return None
+        except RuntimeError as ex:
+            logger.debug(f'Error importing way {area.id}: {ex}')
+            self.invalid_count += 1
+            return None
+
+    def _is_plaza(self, area):
+        return configuration.filter_tags(area.tags, self.tag_filters['plaza'])
+
+
+class _PlazaHandler(_PlazaCollector):
+    """
+    collects plazas, buildings, lines and points.
+    If a plaza index is given, only geometries intersecting the bounds of a plaza are kept.
+    The node refs of all lines are collected in one shared array while reading, see add_line_nodes
+    """
+    def __init__(self, tag_filters, plaza_index=None, geometry_factory=None):
+        super().__init__(tag_filters, geometry_factory)
+        self.plaza_index = plaza_index
         self.buildings = []
         self.points = []
         self.lines = []
-        self.invalid_count = 0
+        self.line_node_refs = array('q')
+        # end of the node refs of each line in line_node_refs
+        self.line_node_ends = array('q')
+        # node coordinates of the lines whose geometry left out nodes at the same location, by line index
+        self.line_node_coords = {}
 
     def node(self, node):
         if self._is_relevant_node(node):
-            point_wkb = WKBFAB.create_point(node)
-            point_geometry = wkblib.loads(point_wkb, hex=True)
+            if self.plaza_index is not None:
+                location = node.location
+                if not self._is_near_plaza((location.lon, location.lat, location.lon, location.lat)):
+                    return
+            point_geometry = self.geometry_factory.create_point(node)
             self.points.append(point_geometry)
 
     def way(self, way):
         if self._is_relevant_way(way):
             try:
-                line_wkb = WKBFAB.create_linestring(way)
-                line_geometry = wkblib.loads(line_wkb, hex=True)
+                if self.plaza_index is not None and not self._is_near_plaza(node_bounds(way.nodes)):
+                    return
+                line_geometry = self.geometry_factory.create_linestring(way)
+                nodes = way.nodes
+                # the coordinates of the other lines are those of their geometry
+                if len(line_geometry.coords) != len(nodes):
+                    self.line_node_coords[len(self.lines)] = array('d', [c for n in nodes for c in (n.lon, n.lat)])
+                self.line_node_refs.extend(n.ref for n in nodes)
+                self.line_node_ends.append(len(self.line_node_refs))
                 self.lines.append({
                     'id': way.id,
                     'geometry': line_geometry,
-                    'tags': {t.k: t.v for t in way.tags}
+                    'tags': {t.k: t.v for t in way.tags},
+                    # kept for the merger, so it doesn't have to read the file again
+                    'version': way.version
                 })
             except InvalidLocationError:
                 logger.debug(f'Encountered invalid location in way {way.id}')
@@ -61,35 +193,34 @@ class _PlazaHandler(osmium.SimpleHandler):
                 logger.debug(f'Error importing way {way.id}: {ex}')
                 self.invalid_count += 1
 
+    def add_line_nodes(self, plaza_index):
+        """
+        give the lines intersecting the bounds of a plaza their node refs and node coordinates and free the rest.
+        Only lines intersecting a plaza get entry points, the merger needs the nodes of those only
+        """
+        start = 0
+        for i, (line, end) in enumerate(zip(self.lines, self.line_node_ends)):
+            if plaza_index.count(line['geometry'].bounds) > 0:
+                line['node_refs'] = self.line_node_refs[start:end]
+                line['node_coords'] = self.line_node_coords.get(i) or \
+                    array('d', [c for coords in line['geometry'].coords for c in coords])
+            start = end
+        logger.debug(f'kept the nodes of {sum("node_refs" in line for line in self.lines)} lines near plazas')
+        self.line_node_refs = array('q')
+        self.line_node_ends = array('q')
+        self.line_node_coords = {}
+
     def area(self, area):
         if self._is_plaza(area):
-            multipolygon_geom = self._create_multipolygon(area)
-            if multipolygon_geom:
-                for polygon in multipolygon_geom.geoms:
-                    plaza = {
-                        'osm_id': area.orig_id(),
-                        'geometry': polygon
-                    }
-                    self.plazas.append(plaza)
+            self._add_plaza(area)
 
         elif self._is_relevant_building(area):
             geometry = self._create_multipolygon(area)
-            if geometry:
+            if geometry and self._is_near_plaza(geometry.bounds):
                 self.buildings.append(geometry)
 
-    def _create_multipolygon(self, area):
-        try:
-            building_wkb = WKBFAB.create_multipolygon(area)
-            return wkblib.loads(building_wkb, hex=True)
-
-        except InvalidLocationError:
-            logger.debug(f'Encountered invalid location in area {area.id}')
-            self.invalid_count += 1
-            return None
-        except RuntimeError as ex:
-            logger.debug(f'Error importing way {area.id}: {ex}')
-            self.invalid_count += 1
-            return None
+    def _is_near_plaza(self, bounds):
+        return self.plaza_index is None or self.plaza_index.count(bounds) > 0
 
     def _is_relevant_node(self, node):
         return node.tags.get("level", "0") == "0" and \
@@ -102,9 +233,6 @@ class _PlazaHandler(osmium.SimpleHandler):
             way.tags.get("railway") == "tram" or \
             configuration.filter_tags(way.tags, self.tag_filters['barrier'])
 
-    def _is_plaza(self, area):
-        return configuration.filter_tags(area.tags, self.tag_filters['plaza'])
-
     def _is_relevant_building(self, area):
         return "building" in area.tags \
             and area.tags.get("layer", "0") == "0"
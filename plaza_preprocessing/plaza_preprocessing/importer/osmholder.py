@@ -1,8 +1,13 @@
-
 class OSMHolder:
-    """holder for importer OSM objects"""
-    def __init__(self, plazas, buildings, lines, points):
+    """
+    holder for importer OSM objects.
+    Besides their geometry, id and tags, lines have a version. Lines near a plaza also have their node refs
+    and the coordinates of the nodes as a flat array of longitudes and latitudes
+    spatial_index_dir is the directory of the cached rtree disk indices of the lines, buildings and points, if any
+    """
+    def __init__(self, plazas, buildings, lines, points, spatial_index_dir=None):
         self.plazas = plazas
         self.buildings = buildings
         self.lines = lines
         self.points = points
+        self.spatial_index_dir = spatial_index_dir
@@ -1,13 +1,13 @@
-from sys import maxsize
 from os import path
 import tempfile
 import logging
-from datetime import datetime
+import numpy as np
 from osmium import SimpleHandler, SimpleWriter
 from osmium.osm.mutable import Way
-from shapely.geometry import Point, LineString
 import plaza_preprocessing.merger.plazatransformer as plazatransformer
 import plaza_preprocessing.merger.osmosishelper as osmosishelper
+import plaza_preprocessing.merger.streammerger as streammerger
+from plaza_preprocessing.importer import importer
 
 logger = logging.getLogger('plaza_preprocessing.merger')
 
@@ -29,21 +29,43 @@ class WayExtractor(SimpleHandler):
             }
 
 
-def merge_plaza_graphs(plazas, osm_file, merged_file, footway_tags):
+def merge_plaza_graphs(plazas, osm_file, merged_file, footway_tags, use_osmosis=False, lines=None,
+                       location_index=importer.DEFAULT_LOCATION_INDEX,
+                       node_deduplication=plazatransformer.DEFAULT_NODE_DEDUPLICATION):
     """
-    merge graph edges of plazas back into the original OSM file
+    merge graph edges of plazas back into the original OSM file.
+    By default, the original file is streamed through pyosmium, with use_osmosis,
+    the plazas are written to temporary files and merged with osmosis.
+    The ways with entry points are taken from the imported lines with nodes if given, the others are read from
+    osm_file with the location index.
+    See PlazaTransformer for node_deduplication
     """
     logger.info(f"Merging {len(plazas)} processed plazas back into {osm_file}")
 
+    if use_osmosis:
+        _merge_with_osmosis(plazas, osm_file, merged_file, footway_tags, lines, location_index, node_deduplication)
+    else:
+        nodes, ways, entry_node_mappings = plazatransformer.create_plaza_objects(
+            plazas, footway_tags, node_deduplication)
+        plaza_ways = _get_plaza_ways(entry_node_mappings, osm_file, lines, location_index)
+        _insert_entry_nodes(plaza_ways, entry_node_mappings)
+        modified_ways = {way.id: way for way in _create_modified_ways(plaza_ways)}
+        streammerger.merge_osm_objects(merged_file, osm_file, nodes, ways, modified_ways)
+
+    logger.info(f"Merged OSM file written to {merged_file}")
+
+
+def _merge_with_osmosis(plazas, osm_file, merged_file, footway_tags, lines, location_index, node_deduplication):
+    """ write the plazas and the modified ways to temporary files and merge them with osmosis """
     with tempfile.TemporaryDirectory() as tempdir:
         plaza_way_file = path.join(tempdir, 'plaza_ways.pbf')
         plaza_node_file = path.join(tempdir, 'plaza_nodes.pbf')
         modified_ways_file = path.join(tempdir, 'modified_ways.pbf')
 
         entry_node_mappings = plazatransformer.transform_plazas(
-            plazas, plaza_node_file, plaza_way_file, footway_tags)
+            plazas, plaza_node_file, plaza_way_file, footway_tags, node_deduplication)
 
-        plaza_ways = _extract_plaza_ways(entry_node_mappings, osm_file)
+        plaza_ways = _get_plaza_ways(entry_node_mappings, osm_file, lines, location_index)
         _insert_entry_nodes(plaza_ways, entry_node_mappings)
 
         _write_modified_ways(plaza_ways, modified_ways_file)
@@ -51,18 +73,76 @@ def merge_plaza_graphs(plazas, osm_file, merged_file, footway_tags):
         osmosishelper.merge_osm_files(
             merged_file, osm_file, plaza_way_file, plaza_node_file, modified_ways_file)
 
-    logger.info(f"Merged OSM file written to {merged_file}")
-
 
 def _insert_entry_nodes(plaza_ways, entry_node_mappings):
     """ insert entry node refs to the ways in the correct position """
     for way_id, entry_nodes in entry_node_mappings.items():
         if way_id not in plaza_ways:
             raise RuntimeError(f"Way {way_id} was not found in original osm file")
-        way_nodes = plaza_ways.get(way_id).get('nodes')
+        plaza_way = plaza_ways.get(way_id)
         logger.debug(f"Inserting {len(entry_nodes)} entry point references into way {way_id}")
-        for entry_node in entry_nodes:
-            way_nodes = _insert_entry_node(entry_node, way_nodes)
+        plaza_way['nodes'] = _insert_entry_node_batch(entry_nodes, plaza_way.get('nodes'))
+
+
+def _insert_entry_node_batch(entry_nodes, way_nodes):
+    """
+    insert all entry nodes of a way at once and return the new way nodes.
+    Entry nodes on a way node are inserted before the first way node with the same coordinates,
+    the others after the start of the closest segment, ordered by their position along it.
+    Unlike inserting them one by one, segments to previously inserted entry nodes are not considered,
+    which only makes a difference for entry nodes that aren't on the way
+    """
+    node_positions = {}
+    for i, node in enumerate(way_nodes):
+        node_positions.setdefault(node['coords'], i)
+
+    # sort keys of the entry nodes: position of the next way node, then interpolated before exact
+    # entry nodes and interpolated ones by their position along the segment
+    insert_keys = [None] * len(entry_nodes)
+    interpolated = []
+    for i, entry_node in enumerate(entry_nodes):
+        position = node_positions.get(entry_node['coords'])
+        if position is None:
+            interpolated.append(i)
+        else:
+            insert_keys[i] = (position, 1, 0.0)
+
+    if interpolated:
+        entry_coords = np.array([entry_nodes[i]['coords'] for i in interpolated], dtype=float)
+        way_coords = np.array([node['coords'] for node in way_nodes], dtype=float)
+        segments, fractions = _closest_segments(entry_coords, way_coords)
+        for i, segment, fraction in zip(interpolated, segments.tolist(), fractions.tolist()):
+            insert_keys[i] = (segment + 1, 0, fraction)
+
+    # like inserting them one by one, later entry nodes with the same key are inserted before earlier ones
+    sorted_entries = sorted(range(len(entry_nodes)), key=lambda i: (insert_keys[i], -i))
+    new_way_nodes = []
+    next_entry = 0
+    for position, node in enumerate(way_nodes):
+        while next_entry < len(sorted_entries) and insert_keys[sorted_entries[next_entry]][0] <= position:
+            new_way_nodes.append(entry_nodes[sorted_entries[next_entry]])
+            next_entry += 1
+        new_way_nodes.append(node)
+    new_way_nodes.extend(entry_nodes[i] for i in sorted_entries[next_entry:])
+    return new_way_nodes
+
+
+def _closest_segments(points, way_coords):
+    """
+    returns the index of the first closest way segment for every point and
+    the position of the closest point along that segment, as fraction of its length
+    """
+    starts = way_coords[:-1]
+    vectors = way_coords[1:] - starts
+    squared_lengths = np.einsum('ij,ij->i', vectors, vectors)
+    # segments without length have their start as closest point
+    squared_lengths[squared_lengths == 0] = 1
+    relative = points[:, np.newaxis, :] - starts[np.newaxis, :, :]
+    fractions = np.clip(np.einsum('mnj,nj->mn', relative, vectors) / squared_lengths, 0, 1)
+    offsets = relative - fractions[:, :, np.newaxis] * vectors
+    squared_distances = np.einsum('mnj,mnj->mn', offsets, offsets)
+    segments = np.argmin(squared_distances, axis=1)
+    return segments, fractions[np.arange(len(points)), segments]
 
 
 def _write_modified_ways(plaza_ways, filename):
@@ -70,16 +150,7 @@ def _write_modified_ways(plaza_ways, filename):
     write the modified ways to an OSM file
     """
     logger.debug(f"Writing modified ways to {filename}")
-    ways = []
-    for way_id, way in plaza_ways.items():
-        node_refs = [node['id'] for node in way['nodes']]
-        osm_way = Way(nodes=node_refs)
-        osm_way.id = way_id
-        osm_way.tags = way['tags']
-        # increase version number to overwrite original way
-        osm_way.version = way['version'] + 1
-        osm_way.timestamp = _create_osm_timestamp()
-        ways.append(osm_way)
+    ways = _create_modified_ways(plaza_ways)
 
     writer = SimpleWriter(filename)
     try:
@@ -89,64 +160,54 @@ def _write_modified_ways(plaza_ways, filename):
         writer.close()
 
 
-def _insert_entry_node(entry_node, way_nodes):
-    """ insert node reference in the correct position of way_nodes """
-    insert_position = _find_insert_position(entry_node, way_nodes)
-    way_nodes.insert(insert_position, entry_node)
-    return way_nodes
-
-
-def _find_insert_position(entry_node, way_nodes):
-    entry_point = Point(entry_node['coords'])
-    exact_match = _find_exact_insert_position(entry_point, way_nodes)
-
-    return exact_match if exact_match is not None else (
-        _find_interpolated_insert_position(entry_point, way_nodes))
+def _create_modified_ways(plaza_ways):
+    """ create OSM ways with the inserted entry nodes """
+    ways = []
+    timestamp = plazatransformer.create_osm_timestamp()
+    for way_id, way in plaza_ways.items():
+        node_refs = [node['id'] for node in way['nodes']]
+        osm_way = Way(nodes=node_refs)
+        osm_way.id = way_id
+        osm_way.tags = way['tags']
+        # increase version number to overwrite original way
+        osm_way.version = way['version'] + 1
+        osm_way.timestamp = timestamp
+        ways.append(osm_way)
+    return ways
 
 
-def _find_exact_insert_position(entry_point, way_nodes):
+def _get_plaza_ways(entry_node_mappings, osm_file, lines, location_index):
     """
-    try to find a point in the way_nodes that overlaps
-    the entry point exactly
+    the ways with entry points, taken from the imported lines with nodes.
+    Only the remaining ones are read from osm_file
     """
-    for i, node in enumerate(way_nodes):
-        way_point = Point(node['coords'])
-        if way_point.equals(entry_point):
-            return i
-    return None
+    plaza_ways = _plaza_ways_from_lines(entry_node_mappings, lines or [])
+    missing_ways = {way_id for way_id in entry_node_mappings if way_id not in plaza_ways}
+    if missing_ways:
+        logger.debug(f"Reading {len(missing_ways)} ways with entry points from {osm_file}")
+        plaza_ways.update(_extract_plaza_ways(missing_ways, osm_file, location_index))
+    return plaza_ways
 
 
-def _find_interpolated_insert_position(entry_point, way_nodes):
+def _plaza_ways_from_lines(entry_node_mappings, lines):
     """
-    draws a line between pairs of way points and returns the
-    index of the end node of the line to which the entry point is
-    closest to
+    collect the ways with entry points from the imported lines, in the format of the WayExtractor.
+    Lines without node refs are skipped
     """
-    logger.debug(
-        f"Entry point {entry_point.coords} is not on way node, finding interpolated position")
-    min_node = {'pos': None, 'distance': maxsize}
-    for i in range(0, len(way_nodes) - 1):
-        start_node = way_nodes[i]
-        end_node = way_nodes[i + 1]
-        line = LineString(
-            [start_node['coords'], end_node['coords']])
-        distance = line.distance(entry_point)
-        if distance == 0:
-            return i + 1
-
-        if distance < min_node['distance']:
-            min_node['pos'] = i + 1
-            min_node['distance'] = distance
-    return min_node['pos']
-
-
-def _extract_plaza_ways(entry_node_mappings, osm_file):
-    way_extractor = WayExtractor(entry_node_mappings)
-    index_type = 'sparse_mem_array'
-    way_extractor.apply_file(osm_file, locations=True, idx=index_type)
-    return way_extractor.ways
+    plaza_ways = {}
+    for line in lines:
+        if line['id'] in entry_node_mappings and 'node_refs' in line:
+            node_coords = line['node_coords']
+            plaza_ways[line['id']] = {
+                'version': line['version'],
+                'nodes': [{'id': ref, 'coords': (node_coords[2 * i], node_coords[2 * i + 1])}
+                          for i, ref in enumerate(line['node_refs'])],
+                'tags': dict(line['tags'])
+            }
+    return plaza_ways
 
 
-def _create_osm_timestamp():
-    now = datetime.utcnow()
-    return now.strftime('%Y-%m-%dT%H:%M:%SZ')
+def _extract_plaza_ways(entry_node_mappings, osm_file, location_index=importer.DEFAULT_LOCATION_INDEX):
+    way_extractor = WayExtractor(entry_node_mappings)
+    importer.apply_with_locations(way_extractor, osm_file, location_index)
+    return way_extractor.ways
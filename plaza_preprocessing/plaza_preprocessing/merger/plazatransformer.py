@@ -1,59 +1,168 @@
+from array import array
 from datetime import datetime
 from osmium import SimpleWriter
 from osmium.osm.mutable import Way, Node
 
 
 OSM_ID_START = (-1) * 10**9
+# OSM stores coordinates as integers of 1e-7 degrees
+OSM_COORDINATE_PRECISION = 10**7
+# one of exact, osm-precision
+DEFAULT_NODE_DEDUPLICATION = 'exact'
 
 
-def transform_plazas(plazas, node_file, way_file, footway_tags):
-    """ transforms plazas to OSM and write them to a file """
+def transform_plazas(plazas, node_file, way_file, footway_tags, node_deduplication=DEFAULT_NODE_DEDUPLICATION):
+    """
+    transforms plazas to OSM and write them to a file.
+    See PlazaTransformer for node_deduplication
+    """
     node_writer = SimpleWriter(node_file)
     way_writer = SimpleWriter(way_file)
+    try:
+        output = OSMWriterOutput(node_writer, way_writer, footway_tags, create_osm_timestamp())
+        return _transform_plazas(plazas, footway_tags, output, node_deduplication)
+    finally:
+        node_writer.close()
+        way_writer.close()
 
+
+def create_plaza_objects(plazas, footway_tags, node_deduplication=DEFAULT_NODE_DEDUPLICATION):
+    """
+    transforms plazas to OSM and returns the nodes, the ways and the entry node mappings.
+    Nodes and ways are sorted by their id, they are kept in flat arrays and created when accessed
+    """
+    plaza_objects = PlazaObjects(footway_tags, create_osm_timestamp())
+    entry_node_mappings = _transform_plazas(plazas, footway_tags, plaza_objects, node_deduplication)
+    return plaza_objects.nodes, plaza_objects.ways, entry_node_mappings
+
+
+def _transform_plazas(plazas, footway_tags, output, node_deduplication):
+    """
+    transforms plazas to OSM, passes the nodes and ways to the output in the order of their ids.
+    Entry nodes of ways shared by several plazas are collected in one list
+    """
     entry_node_mappings = {}
     osm_id_nodes = osm_id_ways = OSM_ID_START
 
-    try:
-        for plaza in plazas:
-            if "graph_edges" not in plaza:
-                raise ValueError(f"No graph edges in {plaza['osm_id']}")
-            if "entry_points" not in plaza:
-                raise ValueError(f"No entry points in {plaza['osm_id']}")
+    for plaza in plazas:
+        if "graph_edges" not in plaza:
+            raise ValueError(f"No graph edges in {plaza['osm_id']}")
+        if "entry_points" not in plaza:
+            raise ValueError(f"No entry points in {plaza['osm_id']}")
 
-            transformer = PlazaTransformer(osm_id_nodes, osm_id_ways, footway_tags)
-            transformer.transform_plaza(plaza)
+        transformer = PlazaTransformer(
+            osm_id_nodes, osm_id_ways, footway_tags, entry_node_mappings, output, node_deduplication)
+        transformer.transform_plaza(plaza)
 
-            # merge entry node mappings
-            entry_node_mappings = {**entry_node_mappings, **transformer.entry_node_mappings}
+        osm_id_nodes = transformer.osm_id_nodes
+        osm_id_ways = transformer.osm_id_ways
+    return entry_node_mappings
 
-            for node in transformer.nodes.values():
-                node_writer.add_node(node)
-            for way in transformer.ways:
-                way_writer.add_way(way)
 
-            osm_id_nodes += len(transformer.nodes)
-            osm_id_ways += len(transformer.ways)
-    finally:
-        node_writer.close()
-        way_writer.close()
-    return entry_node_mappings
+def create_osm_timestamp():
+    now = datetime.utcnow()
+    return now.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class _OSMObjectFactory:
+    """ creates the osmium objects of generated nodes and ways, which all have the same version and timestamp """
+
+    def __init__(self, footway_tags, timestamp):
+        self.footway_tags = [(key, value) for tag in footway_tags for key, value in tag.items()]
+        self.timestamp = timestamp
+
+    def create_node(self, node_id, coords):
+        return Node(location=coords, id=node_id, version=1, timestamp=self.timestamp)
+
+    def create_way(self, way_id, node_refs):
+        return Way(nodes=node_refs, id=way_id, version=1, timestamp=self.timestamp, tags=self.footway_tags)
+
+
+class OSMWriterOutput(_OSMObjectFactory):
+    """ writes generated nodes and ways straight to osmium writers """
+
+    def __init__(self, node_writer, way_writer, footway_tags, timestamp):
+        super().__init__(footway_tags, timestamp)
+        self.node_writer = node_writer
+        self.way_writer = way_writer
+
+    def add_node(self, node_id, coords):
+        self.node_writer.add_node(self.create_node(node_id, coords))
+
+    def add_way(self, way_id, node_refs):
+        self.way_writer.add_way(self.create_way(way_id, node_refs))
+
+
+class PlazaObjects(_OSMObjectFactory):
+    """
+    keeps generated nodes and ways in flat arrays. nodes and ways are sequences
+    of osmium objects, which are created when they are accessed
+    """
+
+    def __init__(self, footway_tags, timestamp):
+        super().__init__(footway_tags, timestamp)
+        self.node_ids = array('q')
+        self.node_coords = array('d')
+        self.way_ids = array('q')
+        self.way_refs = array('q')
+        self.way_ends = array('q')
+        self.nodes = _ObjectSequence(self.node_ids, self._get_node)
+        self.ways = _ObjectSequence(self.way_ids, self._get_way)
+
+    def add_node(self, node_id, coords):
+        self.node_ids.append(node_id)
+        self.node_coords.extend(coords)
+
+    def add_way(self, way_id, node_refs):
+        self.way_ids.append(way_id)
+        self.way_refs.extend(node_refs)
+        self.way_ends.append(len(self.way_refs))
+
+    def _get_node(self, index):
+        coords = (self.node_coords[2 * index], self.node_coords[2 * index + 1])
+        return self.create_node(self.node_ids[index], coords)
+
+    def _get_way(self, index):
+        start = self.way_ends[index - 1] if index > 0 else 0
+        return self.create_way(self.way_ids[index], self.way_refs[start:self.way_ends[index]].tolist())
+
+
+class _ObjectSequence:
+    """ sequence of objects created from their index """
+
+    def __init__(self, ids, create):
+        self.ids = ids
+        self.create = create
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if not -len(self.ids) <= index < len(self.ids):
+            raise IndexError('object index out of range')
+        return self.create(index % len(self.ids))
 
 
 class PlazaTransformer:
     """
-    Transforms plaza graph edges to an OSM Format
+    Transforms plaza graph edges to an OSM Format.
+    With node_deduplication exact, a node is created for every distinct coordinate pair,
+    with osm-precision, coordinates that are the same when stored in OSM share a node
     """
 
-    def __init__(self, start_id_nodes, start_id_ways, footway_tags):
+    def __init__(self, start_id_nodes, start_id_ways, footway_tags, entry_node_mappings=None, output=None,
+                 node_deduplication=DEFAULT_NODE_DEDUPLICATION):
+        if node_deduplication not in ('exact', 'osm-precision'):
+            raise ValueError(f"Unknown node deduplication {node_deduplication}")
         self.osm_id_nodes = start_id_nodes
         self.osm_id_ways = start_id_ways
-        # use coordinates as keys and osmium objects as values
+        # use coordinates, or their OSM fixed-point integers packed into one int, as keys and node ids as values
         self.nodes = {}
-        self.ways = []
-        # maps entry ways of plazas to entry node ids
-        self.entry_node_mappings = {}
-        self.footway_tags = [(key, value) for tag in footway_tags for key, value in tag.items()]
+        self.quantize_coordinates = node_deduplication == 'osm-precision'
+        # maps entry ways of plazas to entry node ids, entry nodes are appended to the ones of previous plazas
+        self.entry_node_mappings = {} if entry_node_mappings is None else entry_node_mappings
+        # receives the created nodes and ways, they are kept in memory by default
+        self.output = PlazaObjects(footway_tags, create_osm_timestamp()) if output is None else output
 
     def transform_plaza(self, plaza):
         """ takes a plaza with edge geometries and constructs nodes and ways """
@@ -62,40 +171,35 @@ class PlazaTransformer:
             self._create_way(edge)
 
         for entry_line in plaza.get('entry_lines'):
-            self.entry_node_mappings[entry_line['way_id']] = [
+            self.entry_node_mappings.setdefault(entry_line['way_id'], []).extend(
                 {
                     'id': self._get_node_id((p.x, p.y)),
                     'coords': (p.x, p.y)
                 }
-                for p in entry_line['entry_points']]
+                for p in entry_line['entry_points'])
 
     def _create_way(self, edge):
         """ create a way with corresponding nodes """
         node_refs = []
         for coords in edge.coords:
-            node_refs.append(self._get_node_id(coords))
-        way_id = self._get_new_way_osm_id()
-        way = Way(nodes=node_refs)
-        way.tags = self.footway_tags
-        way.id = way_id
-        way.version = 1
-        way.timestamp = self._create_osm_timestamp()
-        self.ways.append(way)
+            node_id = self._get_node_id(coords)
+            # consecutive coordinates can share a node with osm-precision
+            if not node_refs or node_refs[-1] != node_id:
+                node_refs.append(node_id)
+        if len(node_refs) > 1:
+            self.output.add_way(self._get_new_way_osm_id(), node_refs)
 
     def _get_node_id(self, coords):
         """
         get a node id for the coords, creates a new node if it doesn't exist yet
         """
-        if coords in self.nodes:
-            return self.nodes[coords].id
-        else:
+        key = _fixed_point_key(coords) if self.quantize_coordinates else coords
+        node_id = self.nodes.get(key)
+        if node_id is None:
             node_id = self._get_new_node_osm_id()
-            node = Node(location=coords)
-            node.id = node_id
-            node.version = 1
-            node.timestamp = self._create_osm_timestamp()
-            self.nodes[coords] = node
-            return node_id
+            self.output.add_node(node_id, coords)
+            self.nodes[key] = node_id
+        return node_id
 
     def _get_new_node_osm_id(self):
         self.osm_id_nodes += 1
@@ -105,6 +209,9 @@ class PlazaTransformer:
         self.osm_id_ways += 1
         return self.osm_id_ways
 
-    def _create_osm_timestamp(self):
-        now = datetime.utcnow()
-        return now.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _fixed_point_key(coords):
+    """ the coordinates as OSM fixed-point integers, rounded like osmium, packed into one int """
+    lon = int(coords[0] * OSM_COORDINATE_PRECISION + (0.5 if coords[0] >= 0 else -0.5))
+    lat = int(coords[1] * OSM_COORDINATE_PRECISION + (0.5 if coords[1] >= 0 else -0.5))
+    return (lon << 32) | (lat & 0xffffffff)
@@ -0,0 +1,79 @@
+"""
+Merge the generated plaza nodes and ways into an OSM file with pyosmium.
+The original file is read once and written in the same pass: modified ways replace
+the original ones in-line and the generated objects are inserted where their id belongs,
+so a sorted input file results in a sorted output file, like with osmosis --merge
+"""
+import logging
+import os
+from os import path
+from osmium import SimpleHandler, SimpleWriter
+
+logger = logging.getLogger('plaza_preprocessing.merger')
+
+
+def merge_osm_objects(out_file, osm_file, nodes, ways, modified_ways):
+    """
+    write osm_file to out_file with the nodes and ways added and the ways in modified_ways
+    (a dict by way id) replaced. nodes and ways have to be sorted by their id
+    """
+    logger.debug(f"Merging {len(nodes)} nodes, {len(ways)} ways and {len(modified_ways)} modified ways "
+                 f"into {osm_file}")
+    if path.exists(out_file):
+        # osmium refuses to overwrite files, osmosis did
+        os.remove(out_file)
+    writer = SimpleWriter(out_file)
+    try:
+        stream_merger = _StreamMerger(writer, nodes, ways, modified_ways)
+        stream_merger.apply_file(osm_file)
+        stream_merger.finish()
+    finally:
+        writer.close()
+    if stream_merger.modified_ways:
+        missing_ids = ', '.join(str(way_id) for way_id in stream_merger.modified_ways)
+        raise RuntimeError(f"Ways {missing_ids} were not found in original osm file")
+
+
+class _StreamMerger(SimpleHandler):
+    """ copies all objects to the writer and inserts the generated objects before the first larger id """
+
+    def __init__(self, writer, nodes, ways, modified_ways):
+        super().__init__()
+        self.writer = writer
+        self.nodes = nodes
+        self.ways = ways
+        self.modified_ways = dict(modified_ways)
+        self.next_node = 0
+        self.next_way = 0
+
+    def node(self, node):
+        self._write_nodes_before(node.id)
+        self.writer.add_node(node)
+
+    def way(self, way):
+        self._write_nodes_before(None)
+        self._write_ways_before(way.id)
+        modified_way = self.modified_ways.pop(way.id, None)
+        self.writer.add_way(way if modified_way is None else modified_way)
+
+    def relation(self, relation):
+        self._write_nodes_before(None)
+        self._write_ways_before(None)
+        self.writer.add_relation(relation)
+
+    def finish(self):
+        """ write the generated objects with ids larger than all original ones """
+        self._write_nodes_before(None)
+        self._write_ways_before(None)
+
+    def _write_nodes_before(self, osm_id):
+        """ write the generated nodes with an id smaller than osm_id, all of them for None """
+        while self.next_node < len(self.nodes) and (osm_id is None or self.nodes[self.next_node].id < osm_id):
+            self.writer.add_node(self.nodes[self.next_node])
+            self.next_node += 1
+
+    def _write_ways_before(self, osm_id):
+        """ write the generated ways with an id smaller than osm_id, all of them for None """
+        while self.next_way < len(self.ways) and (osm_id is None or self.ways[self.next_way].id < osm_id):
+            self.writer.add_way(self.ways[self.next_way])
+            self.next_way += 1
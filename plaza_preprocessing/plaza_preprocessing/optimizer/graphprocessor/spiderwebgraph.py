@@ -1,6 +1,9 @@
-from math import ceil
+from math import ceil, sqrt
 from typing import List
+import numpy as np
+import rtree
 from shapely.geometry import Point, LineString, Polygon
+from shapely.prepared import prep
 from plaza_preprocessing.optimizer import utils
 from plaza_preprocessing.optimizer.graphprocessor.graphprocessor import GraphProcessor
 
@@ -44,58 +47,67 @@ class SpiderWebGraphProcessor(GraphProcessor):
         rows = int(ceil((y_top - y_bottom) / spacing))
         columns = int(ceil((x_right - x_left) / spacing))
 
-        graph_edges = []
+        xs = x_left + np.arange(columns + 2) * spacing
+        ys = y_bottom + np.arange(rows + 2) * spacing
+        grid_points = [(x, y) for x in xs.tolist() for y in ys.tolist()]
+        start_ids, end_ids = self._spiderweb_segment_ids(rows, columns)
+
+        visibility_checker = utils.VisibilityChecker(plaza_geometry, self.visibility_delta_m)
+        # segments ending farther than delta away from the plaza can't be visible
+        in_buffer = _points_in(visibility_checker.prepared_plaza_buffer, grid_points)
+        # segments starting deep inside the plaza can't leave it
+        inner_plaza = prep(plaza_geometry.buffer(-2 * sqrt(2) * spacing))
+        in_inner_plaza = _points_in(inner_plaza, grid_points)
 
-        for column in range(0, columns + 1):
-            for row in range(0, rows + 1):
-
-                x_1 = x_left + (column * spacing)
-                x_2 = x_left + ((column + 1) * spacing)
-                y_1 = y_bottom + (row * spacing)
-                y_2 = y_bottom + ((row + 1) * spacing)
-
-                top_left = (x_1, y_1)
-                top_right = (x_2, y_1)
-                bottom_left = (x_1, y_2)
-                bottom_right = (x_2, y_2)
-
-                # horizontal line
-                if column < columns:
-                    h_line = self._get_spiderweb_intersection_line(plaza_geometry, top_left, top_right)
-                    if h_line:
-                        graph_edges.append(h_line)
-
-                # vertical line
-                if row < rows:
-                    v_line = self._get_spiderweb_intersection_line(plaza_geometry, top_left, bottom_left)
-                    if v_line:
-                        graph_edges.append(v_line)
-
-                # diagonal line
-                if row < rows and column < columns:
-                    d1_line = self._get_spiderweb_intersection_line(plaza_geometry, top_left, bottom_right)
-                    if d1_line:
-                        graph_edges.append(d1_line)
-                    d2_line = self._get_spiderweb_intersection_line(plaza_geometry, bottom_left, top_right)
-                    if d2_line:
-                        graph_edges.append(d2_line)
+        candidates = in_buffer[start_ids] & in_buffer[end_ids]
+        inside = in_inner_plaza[start_ids] | in_inner_plaza[end_ids]
+
+        graph_edges = []
+        for start_id, end_id, is_inside in zip(start_ids[candidates].tolist(), end_ids[candidates].tolist(),
+                                               inside[candidates].tolist()):
+            line = LineString([grid_points[start_id], grid_points[end_id]])
+            if is_inside or visibility_checker.line_visible(line):
+                graph_edges.append(line)
         return graph_edges
 
-    def _get_spiderweb_intersection_line(self, plaza_geometry, start, end):
-        """ returns a line that is completely inside the plaza, if possible """
-        line = LineString([start, end])
-        if not utils.line_visible(plaza_geometry, line, self.visibility_delta_m):
-            return None
-        return line
+    def _spiderweb_segment_ids(self, rows, columns):
+        """
+        returns the ids of the start and end points of all grid segments,
+        with the horizontal, vertical and both diagonal segments of each cell, column by column
+        """
+        column_ids, row_ids = np.meshgrid(np.arange(columns + 1), np.arange(rows + 1), indexing='ij')
+        column_ids = column_ids[..., np.newaxis]
+        row_ids = row_ids[..., np.newaxis]
+
+        # offsets of the segment ends in the order horizontal, vertical, diagonal, diagonal
+        start_row_offsets = np.array([0, 0, 0, 1])
+        end_column_offsets = np.array([1, 0, 1, 1])
+        end_row_offsets = np.array([0, 1, 1, 0])
+
+        in_row = row_ids < rows
+        in_column = column_ids < columns
+        existing = np.concatenate([in_column, in_row, in_row & in_column, in_row & in_column], axis=-1)
+
+        point_rows = rows + 2
+        start_ids = column_ids * point_rows + row_ids + start_row_offsets
+        end_ids = (column_ids + end_column_offsets) * point_rows + row_ids + end_row_offsets
+        return start_ids[existing], end_ids[existing]
 
     def _connect_entry_points_with_graph(self, entry_points, graph_edges):
+        """ connect every entry point with the nearest node of the graph """
+        nodes = list(dict.fromkeys(coords for line in graph_edges for coords in line.coords))
+        node_index = rtree.index.Index((i, coords + coords, None) for i, coords in enumerate(nodes))
+
         connection_lines = []
         for entry_point in entry_points:
-            neighbor_line = utils.find_nearest_geometry(entry_point, graph_edges)
-
-            target_point = min(
-                neighbor_line.coords, key=lambda c: Point(c).distance(entry_point))
-            connection_line = (LineString([(entry_point.x, entry_point.y), target_point]))
+            entry_coords = (entry_point.x, entry_point.y)
+            target_point = nodes[next(node_index.nearest(entry_coords + entry_coords, 1))]
+            connection_line = (LineString([entry_coords, target_point]))
             connection_lines.append(connection_line)
         graph_edges.extend(connection_lines)
         return graph_edges
+
+
+def _points_in(prepared_geometry, points):
+    """ returns a boolean array, which is True for the points contained in the prepared geometry """
+    return np.fromiter((prepared_geometry.contains(Point(p)) for p in points), dtype=bool, count=len(points))
@@ -0,0 +1,401 @@
+from math import atan2, pi
+from typing import List
+from shapely.geometry import Point, LineString, Polygon
+from shapely.geometry.polygon import orient
+from shapely.prepared import prep
+from plaza_preprocessing.optimizer import utils
+from plaza_preprocessing.optimizer.graphprocessor.graphprocessor import GraphProcessor
+
+# tolerance for collinearity, relative to the lengths of the vectors
+COLLINEAR_TOLERANCE = 1e-9
+# angles closer than this are checked for collinearity
+ANGLE_TOLERANCE = 1e-8
+# tolerance for crossings at the ends of a line, relative to its length
+DISTANCE_TOLERANCE = 1e-9
+# tolerance for points lying on an edge, relative to the visibility delta
+ON_EDGE_TOLERANCE = 1e-3
+# below this number of vertices, checking every pair of vertices is faster than the sweep
+SWEEP_MIN_VERTICES = 16
+
+# how a line leaves a vertex
+INSIDE = 1
+OUTSIDE = -1
+UNCERTAIN = 0
+
+
+class SweepVisibilityGraphProcessor(GraphProcessor):
+    """
+    process a plaza using a visibility graph constructed with Lee's rotational sweep.
+    Instead of intersecting every pair of points with the plaza, the plaza edges crossed by a
+    ray rotating around each point are kept in a list sorted by their distance along the ray,
+    which is updated with binary searches. Lines the sweep can't decide with certainty, e.g. lines
+    along the plaza boundary or through other vertices, are checked with the VisibilityChecker,
+    so the graph has the same edges as the one of the VisibilityGraphProcessor.
+    Small plazas are processed by checking every pair of vertices, see SWEEP_MIN_VERTICES
+    """
+
+    def __init__(self, visibility_delta_m):
+        self.visibility_delta_m = visibility_delta_m
+
+    def create_graph_edges(self, plaza_geometry: Polygon, entry_points: List[Point]) -> List[LineString]:
+        """ create a visibility graph with all plaza and entry points """
+        if not plaza_geometry:
+            raise ValueError("Plaza geometry not defined for visibility graph processor")
+        if not entry_points:
+            raise ValueError("No entry points defined for graph processor")
+
+        plaza_coords = utils.get_polygon_coords(plaza_geometry)
+        entry_coords = [(p.x, p.y) for p in entry_points]
+        vertices = list(set().union(plaza_coords, entry_coords))
+        if len(vertices) < SWEEP_MIN_VERTICES:
+            visibility_checker = utils.VisibilityChecker(plaza_geometry, self.visibility_delta_m)
+            lines = (LineString([vertices[start_id], vertices[end_id]])
+                     for start_id in range(len(vertices)) for end_id in range(start_id + 1, len(vertices)))
+            return [line for line in lines if visibility_checker.line_visible(line)]
+
+        sweep = _RotationalSweep(plaza_geometry, vertices, self.visibility_delta_m)
+
+        graph_edges = []
+        for start_id in range(len(vertices)):
+            for end_id in sweep.visible_vertices(start_id):
+                graph_edges.append(LineString([vertices[start_id], vertices[end_id]]))
+        return graph_edges
+
+
+class _RotationalSweep:
+    """
+    finds the vertices visible from a vertex by sweeping a ray around it.
+    The plaza edges crossed by the ray are stored in a list sorted by their distance along the ray;
+    plaza edges don't cross each other, so this order stays valid while the ray rotates.
+    An edge enters or leaves the list whenever the ray passes one of its ends.
+
+    Like in line_visible, a line is visible if it runs outside of the plaza for at most delta.
+    The sweep adds up the parts outside between the crossings, lines where this isn't certain
+    are checked with line_visible
+    """
+
+    def __init__(self, plaza_geometry, vertices, delta_m):
+        self.vertices = vertices
+        self.delta = utils.meters_to_degrees(delta_m)
+        self.visibility_checker = utils.VisibilityChecker(plaza_geometry, delta_m)
+        vertex_ids = {coords: i for i, coords in enumerate(vertices)}
+
+        # with the exterior counterclockwise and the interiors clockwise, the plaza is left of every edge
+        oriented_plaza = orient(plaza_geometry)
+        self.edges = []
+        for ring in [oriented_plaza.exterior] + list(oriented_plaza.interiors):
+            ring_ids = [vertex_ids[coords] for coords in ring.coords]
+            self.edges.extend((start, end) for start, end in zip(ring_ids, ring_ids[1:]) if start != end)
+
+        self.incident_edges = [[] for _ in vertices]
+        for edge_id, (start, end) in enumerate(self.edges):
+            self.incident_edges[start].append(edge_id)
+            self.incident_edges[end].append(edge_id)
+        # edges that end at a vertex or contain it, like entry points on the plaza boundary
+        self.touching_edges = [set(edge_ids) for edge_ids in self.incident_edges]
+        prepared_plaza = prep(plaza_geometry)
+        self.directions = [self._vertex_directions(vertex_id, prepared_plaza) for vertex_id in range(len(vertices))]
+
+    def visible_vertices(self, origin_id):
+        """ returns the ids of the vertices with a larger id than the origin that are visible from it """
+        origin = self.vertices[origin_id]
+        relative = [_vector(origin, vertex) for vertex in self.vertices]
+        angles = [_angle(vector) for vector in relative]
+        others = [i for i in range(len(self.vertices)) if i != origin_id]
+        others.sort(key=lambda i: (angles[i], _dot(relative[i], relative[i])))
+        sorted_angles = [angles[i] for i in others]
+
+        sweep_state = _SweepState(self, relative, origin_id)
+        # the sweep starts with a ray parallel to the x axis, crossing the edges which span more than pi in angles
+        initial_edges = [edge_id for edge_id, (start, end) in enumerate(self.edges)
+                         if sweep_state.is_obstacle[edge_id] and abs(angles[start] - angles[end]) > pi]
+        sweep_state.start(initial_edges)
+
+        visible = []
+        for position, vertex_id in enumerate(others):
+            if vertex_id > origin_id:
+                is_visible = self._decide_visibility(sweep_state, origin_id, vertex_id, others, sorted_angles, position)
+                if is_visible is None:
+                    is_visible = self.visibility_checker.line_visible(
+                        LineString([origin, self.vertices[vertex_id]]))
+                if is_visible:
+                    visible.append(vertex_id)
+            sweep_state.pass_vertex(vertex_id)
+        return visible
+
+    def _decide_visibility(self, sweep_state, origin_id, vertex_id, others, sorted_angles, position):
+        """ True or False if the line from the origin to the vertex is certainly visible or not, None otherwise """
+        direction = sweep_state.relative[vertex_id]
+        if self._passes_vertex(sweep_state.relative, direction, others, sorted_angles, position):
+            return None
+        if self.touching_edges[origin_id] & self.touching_edges[vertex_id]:
+            # both ends lie on the same edge, whether the line runs along it or slightly outside is up to rounding
+            return None
+
+        origin_direction = self._leaving_direction(origin_id, direction)
+        vertex_direction = self._leaving_direction(vertex_id, (-direction[0], -direction[1]))
+        if UNCERTAIN in (origin_direction, vertex_direction):
+            return None
+        crossings = sweep_state.crossings(direction, self.touching_edges[vertex_id])
+        # the line changes between inside and outside at every crossing, which has to match how it reaches the vertex
+        if crossings is None or (len(crossings) % 2 == 0) != (origin_direction == vertex_direction):
+            return None
+
+        # like line_visible, the line is visible if it runs outside of the plaza for at most delta
+        outside_length = 0
+        inside = origin_direction == INSIDE
+        previous_distance = 0
+        for distance in crossings + [1]:
+            if not inside:
+                outside_length += distance - previous_distance
+            inside = not inside
+            previous_distance = distance
+        outside_length *= _length(direction)
+        if abs(outside_length - self.delta) <= self.delta * ON_EDGE_TOLERANCE:
+            return None
+        return outside_length < self.delta
+
+    def _passes_vertex(self, relative, direction, others, sorted_angles, position):
+        """ check if the line passes through another vertex, where it may leave the plaza or not """
+        angle = sorted_angles[position]
+        for other_position in _positions_near_angle(sorted_angles, position, angle):
+            other = relative[others[other_position]]
+            if _side(direction, other) == 0 and 0 < _dot(other, direction) < _dot(direction, direction):
+                return True
+        return False
+
+    def _leaving_direction(self, vertex_id, direction):
+        """ whether a line leaving the vertex in the direction starts inside or outside the plaza """
+        kind, vectors = self.directions[vertex_id]
+        if kind == 'corner':
+            outgoing, incoming = vectors
+            turn = _side(outgoing, incoming)
+            side_outgoing = _side(outgoing, direction)
+            side_incoming = _side(direction, incoming)
+            if side_outgoing == 0 or side_incoming == 0:
+                return UNCERTAIN
+            if turn > 0:
+                return INSIDE if side_outgoing > 0 and side_incoming > 0 else OUTSIDE
+            if turn < 0:
+                return INSIDE if side_outgoing > 0 or side_incoming > 0 else OUTSIDE
+            # a straight angle, the plaza is left of the outgoing edge
+            return side_outgoing if _dot(outgoing, incoming) < 0 else UNCERTAIN
+        if kind == 'edge':
+            return _side(vectors, direction)
+        return kind
+
+    def _vertex_directions(self, vertex_id, prepared_plaza):
+        """
+        describe the directions in which lines leave a vertex into the plaza:
+        ('corner', (outgoing, incoming)) with the vectors to the next and previous vertex of a ring,
+        ('edge', edge vector) for a point on an edge, INSIDE or OUTSIDE for all directions or UNCERTAIN
+        """
+        vertex = self.vertices[vertex_id]
+        incident_edges = self.incident_edges[vertex_id]
+        if incident_edges:
+            outgoing = [self.edges[edge_id][1] for edge_id in incident_edges if self.edges[edge_id][0] == vertex_id]
+            incoming = [self.edges[edge_id][0] for edge_id in incident_edges if self.edges[edge_id][1] == vertex_id]
+            if len(outgoing) != 1 or len(incoming) != 1:
+                # rings touching each other
+                return UNCERTAIN, None
+            return 'corner', (_vector(vertex, self.vertices[outgoing[0]]), _vector(vertex, self.vertices[incoming[0]]))
+
+        containing_edges = [edge_id for edge_id, (start, end) in enumerate(self.edges)
+                            if _segment_distance(vertex, self.vertices[start], self.vertices[end]) <
+                            self.delta * ON_EDGE_TOLERANCE]
+        self.touching_edges[vertex_id].update(containing_edges)
+        if len(containing_edges) == 1:
+            start, end = self.edges[containing_edges[0]]
+            return 'edge', _vector(self.vertices[start], self.vertices[end])
+        if containing_edges:
+            return UNCERTAIN, None
+        return (INSIDE if prepared_plaza.contains(Point(vertex)) else OUTSIDE), None
+
+
+class _SweepState:
+    """ the edges crossed by the ray around an origin, sorted by their distance along the ray """
+
+    def __init__(self, sweep, relative, origin_id):
+        self.sweep = sweep
+        self.relative = relative
+        self.origin = sweep.vertices[origin_id]
+        # edges touching the origin cross every ray at the origin, they're covered by its leaving directions
+        touching_origin = sweep.touching_edges[origin_id]
+        self.is_obstacle = [edge_id not in touching_origin for edge_id in range(len(sweep.edges))]
+        self.is_active = [False] * len(sweep.edges)
+        self.active_edges = []
+        # start and vector of every edge relative to the origin and the numerator of its distance along a ray,
+        # which is the same for every ray
+        self.relative_edges = []
+        for start, end in sweep.edges:
+            edge_vector = _vector(relative[start], relative[end])
+            self.relative_edges.append(relative[start] + edge_vector + (_cross(relative[start], edge_vector),))
+
+    def start(self, initial_edges):
+        """ start the sweep with the edges crossed by the ray parallel to the x axis """
+        direction = (1, 0)
+        distances = {edge_id: self.ray_distance(edge_id, direction) for edge_id in initial_edges}
+        self.active_edges = sorted(initial_edges, key=distances.get)
+        for edge_id in initial_edges:
+            self.is_active[edge_id] = True
+
+    def pass_vertex(self, vertex_id):
+        """ the ray passes a vertex: its edges leave the list if they were crossed until now, otherwise they enter it """
+        direction = self.relative[vertex_id]
+        entering_edges = []
+        for edge_id in self.sweep.incident_edges[vertex_id]:
+            if not self.is_obstacle[edge_id]:
+                continue
+            if self.is_active[edge_id]:
+                self._remove_edge(edge_id, direction)
+            else:
+                entering_edges.append(edge_id)
+        for edge_id in entering_edges:
+            self._insert_edge(edge_id, vertex_id, direction)
+
+    def crossings(self, direction, touching_edges):
+        """
+        returns the sorted distances of the crossings of the line from the origin in the direction with the edges,
+        relative to its length. Edges touching the end of the line are left out.
+        Crossings are only accepted if they are clearly inside of the line, otherwise None is returned
+        """
+        end_position = self._bisect(direction, 1 - DISTANCE_TOLERANCE)
+        position = end_position
+        while position < len(self.active_edges) and \
+                self.ray_distance(self.active_edges[position], direction) <= 1 + DISTANCE_TOLERANCE:
+            if self.active_edges[position] not in touching_edges:
+                return None
+            position += 1
+
+        distances = [self.ray_distance(edge_id, direction) for edge_id in self.active_edges[:end_position]
+                     if edge_id not in touching_edges]
+        if distances and distances[0] < DISTANCE_TOLERANCE:
+            return None
+        return distances
+
+    def ray_distance(self, edge_id, direction):
+        """ distance of the crossing of the edge along the ray, relative to the length of direction """
+        # this is called for every comparison of edges, so the vector operations are written out
+        start_x, start_y, edge_x, edge_y, numerator = self.relative_edges[edge_id]
+        direction_x, direction_y = direction
+        squared_length = direction_x * direction_x + direction_y * direction_y
+        start_distance = (direction_x * start_x + direction_y * start_y) / squared_length
+        end_distance = start_distance + (direction_x * edge_x + direction_y * edge_y) / squared_length
+        if start_distance > end_distance:
+            start_distance, end_distance = end_distance, start_distance
+        denominator = direction_x * edge_y - direction_y * edge_x
+        if denominator == 0:
+            # the edge is parallel to the ray, use its closer end
+            return start_distance
+        distance = numerator / denominator
+        # the crossing lies between the ends of the edge, even if rounding puts it elsewhere
+        if distance < start_distance:
+            return start_distance
+        return end_distance if distance > end_distance else distance
+
+    def _bisect(self, direction, distance):
+        """ position of the first active edge crossing the ray at the distance or farther """
+        low, high = 0, len(self.active_edges)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ray_distance(self.active_edges[middle], direction) < distance:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _remove_edge(self, edge_id, direction):
+        """ remove an edge ending at the vertex in the direction, it's found among the edges crossing the ray there """
+        self.is_active[edge_id] = False
+        position = self._bisect(direction, 1 - DISTANCE_TOLERANCE)
+        while position < len(self.active_edges) and \
+                self.ray_distance(self.active_edges[position], direction) <= 1 + DISTANCE_TOLERANCE:
+            if self.active_edges[position] == edge_id:
+                del self.active_edges[position]
+                return
+            position += 1
+        # the list is only slightly out of order due to rounding
+        self.active_edges.remove(edge_id)
+
+    def _insert_edge(self, edge_id, vertex_id, direction):
+        """ insert an edge starting at the vertex in the direction, keeping the active edges sorted by distance """
+        self.is_active[edge_id] = True
+        vertex = self.relative[vertex_id]
+        other = self._other_end(edge_id, vertex_id)
+        position = self._bisect(direction, 1 - DISTANCE_TOLERANCE)
+        # edges crossing the ray at the same vertex are sorted by which of them is closer to the origin
+        while position < len(self.active_edges) and \
+                self.ray_distance(self.active_edges[position], direction) <= 1 + DISTANCE_TOLERANCE:
+            active_other = self._ccw_end(self.active_edges[position], direction)
+            if _side(_vector(vertex, active_other), (-vertex[0], -vertex[1])) * \
+                    _side(_vector(vertex, active_other), _vector(vertex, other)) < 0:
+                position += 1
+            else:
+                break
+        self.active_edges.insert(position, edge_id)
+
+    def _other_end(self, edge_id, vertex_id):
+        start, end = self.sweep.edges[edge_id]
+        return self.relative[end if start == vertex_id else start]
+
+    def _ccw_end(self, edge_id, direction):
+        """ the end of an edge lying counterclockwise of the ray """
+        start, end = (self.relative[i] for i in self.sweep.edges[edge_id])
+        return start if _side(direction, start) > 0 else end
+
+
+def _positions_near_angle(sorted_angles, position, angle):
+    """ positions of the other vertices with almost the same angle, also across the start of the sweep """
+    near_positions = []
+    for step in (-1, 1):
+        other_position = position + step
+        while 0 <= other_position < len(sorted_angles) and abs(sorted_angles[other_position] - angle) <= ANGLE_TOLERANCE:
+            near_positions.append(other_position)
+            other_position += step
+    if angle <= ANGLE_TOLERANCE or angle >= 2 * pi - ANGLE_TOLERANCE:
+        near_positions.extend(i for i, other_angle in enumerate(sorted_angles)
+                              if i != position and min(other_angle, 2 * pi - other_angle) <= ANGLE_TOLERANCE)
+    return near_positions
+
+
+def _angle(vector):
+    """ angle of the vector between 0 and 2 pi """
+    angle = atan2(vector[1], vector[0])
+    return angle + 2 * pi if angle < 0 else angle
+
+
+def _vector(start, end):
+    return end[0] - start[0], end[1] - start[1]
+
+
+def _cross(vector_1, vector_2):
+    return vector_1[0] * vector_2[1] - vector_1[1] * vector_2[0]
+
+
+def _dot(vector_1, vector_2):
+    return vector_1[0] * vector_2[0] + vector_1[1] * vector_2[1]
+
+
+def _length(vector):
+    return _dot(vector, vector) ** 0.5
+
+
+def _segment_distance(point, start, end):
+    """ distance of a point to the line segment between start and end """
+    edge_vector = _vector(start, end)
+    point_vector = _vector(start, point)
+    edge_length_squared = _dot(edge_vector, edge_vector)
+    if edge_length_squared == 0:
+        return _length(point_vector)
+    fraction = min(1, max(0, _dot(point_vector, edge_vector) / edge_length_squared))
+    closest = (start[0] + fraction * edge_vector[0], start[1] + fraction * edge_vector[1])
+    return _length(_vector(closest, point))
+
+
+def _side(vector_1, vector_2):
+    """ 1 if vector_2 is counterclockwise of vector_1, -1 if clockwise and 0 if they are collinear """
+    cross = vector_1[0] * vector_2[1] - vector_1[1] * vector_2[0]
+    # compared squared, which saves the square roots of the lengths
+    if cross * cross <= COLLINEAR_TOLERANCE * COLLINEAR_TOLERANCE * _dot(vector_1, vector_1) * _dot(vector_2, vector_2):
+        return 0
+    return 1 if cross > 0 else -1
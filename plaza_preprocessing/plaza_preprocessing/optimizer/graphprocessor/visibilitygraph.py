@@ -21,12 +21,13 @@ class VisibilityGraphProcessor(GraphProcessor):
         entry_coords = [(p.x, p.y) for p in entry_points]
         all_coords = set().union(plaza_coords, entry_coords)
         indexed_coords = {i: coords for i, coords in enumerate(all_coords)}
+        visibility_checker = utils.VisibilityChecker(plaza_geometry, self.visibility_delta_m)
 
         graph_edges = []
         for start_id, start_coords in indexed_coords.items():
             for end_id, end_coords in indexed_coords.items():
                 if start_id > end_id:
                     line = LineString([start_coords, end_coords])
-                    if utils.line_visible(plaza_geometry, line, self.visibility_delta_m):
+                    if visibility_checker.line_visible(line):
                         graph_edges.append(line)
         return graph_edges
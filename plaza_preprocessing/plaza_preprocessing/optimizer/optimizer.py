@@ -1,68 +1,206 @@
 import logging
-from typing import List
+import multiprocessing
+import time
+from os import path
+from typing import List, Dict, Tuple
+import numpy as np
 import rtree
 from shapely.geometry import Point, MultiPolygon, Polygon, LineString, box
 from plaza_preprocessing.optimizer import utils
-from plaza_preprocessing.optimizer import shortest_paths
+from plaza_preprocessing.optimizer import shortest_paths, plazastate, resultcache
 from plaza_preprocessing.optimizer.graphprocessor.graphprocessor import GraphProcessor
 from plaza_preprocessing.importer.osmholder import OSMHolder
 from plaza_preprocessing import configuration
 from shapely.geometry import CAP_STYLE, JOIN_STYLE
+from shapely.ops import unary_union
 
 logger = logging.getLogger('plaza_preprocessing.optimizer')
 
+# keys of a processed plaza that are stored in the result cache
+RESULT_KEYS = ['geometry', 'entry_points', 'entry_lines', 'graph_edges']
 
-def preprocess_plazas(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy, config: dict):
-    """ preprocess all plazas from osm_importer """
-    logger.info(f"Start processing {len(osm_holder.plazas)} plazas")
-    plaza_processor = PlazaPreprocessor(
-        osm_holder, process_strategy, shortest_path_strategy, config)
-    processed_plazas = plaza_processor.process_plazas()
 
+def preprocess_plazas(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy, config: dict,
+                      workers=1, result_cache=None):
+    """
+    preprocess all plazas from osm_importer.
+    With more than one worker, the plazas are distributed over a process pool.
+    With a result cache, plazas whose result is cached are not processed again
+    """
+    logger.info(f"Start processing {len(osm_holder.plazas)} plazas")
+    plaza_results = process_plaza_results(
+        osm_holder, process_strategy, shortest_path_strategy, config, workers, result_cache)
+    processed_plazas = [plaza for plaza in plaza_results if plaza is not None]
     logger.info(f"Finished processing {len(processed_plazas)} plazas (rest were discarded)")
     return processed_plazas
 
 
+def preprocess_changed_plazas(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy,
+                              config: dict, previous_results: Dict, changed_bounds: List[Tuple], workers=1,
+                              result_cache=None) -> Dict:
+    """
+    process only the plazas that changed since the previous run and reuse the previous results for the others.
+    Returns the results of all plazas by their key, None for discarded plazas
+    """
+    plaza_keys = [plazastate.plaza_key(plaza) for plaza in osm_holder.plazas]
+    changed = plazastate.find_changed_plazas(osm_holder.plazas, previous_results, changed_bounds)
+    changed_plazas = [plaza for plaza, is_changed in zip(osm_holder.plazas, changed) if is_changed]
+    logger.info(f"Start processing {len(changed_plazas)} changed plazas, "
+                f"reusing the results of {len(plaza_keys) - len(changed_plazas)} plazas")
+
+    changed_holder = OSMHolder(changed_plazas, osm_holder.buildings, osm_holder.lines, osm_holder.points,
+                               spatial_index_dir=osm_holder.spatial_index_dir)
+    new_results = iter(process_plaza_results(
+        changed_holder, process_strategy, shortest_path_strategy, config, workers, result_cache))
+    return {key: next(new_results) if is_changed else previous_results[key]
+            for key, is_changed in zip(plaza_keys, changed)}
+
+
+def process_plaza_results(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy,
+                          config: dict, workers=1, result_cache=None):
+    """ process all plazas and return the result for each of them, None for discarded plazas """
+    if workers > 1:
+        return _process_plazas_parallel(
+            osm_holder, process_strategy, shortest_path_strategy, config, workers, result_cache)
+    plaza_processor = PlazaPreprocessor(osm_holder, process_strategy, shortest_path_strategy, config, result_cache)
+    plaza_results = []
+    for plaza in plaza_processor.plazas:
+        logger.info(f"Processing plaza {plaza['osm_id']}")
+        plaza_results.append(plaza_processor._process_plaza(plaza))
+    return plaza_results
+
+
+# preprocessor of the current worker process, see _init_worker
+_worker_preprocessor = None
+
+
+def _process_plazas_parallel(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy,
+                             config: dict, workers: int, result_cache=None):
+    """
+    process plazas in a pool of worker processes.
+    Every worker receives the holder once and builds its own spatial indices,
+    tasks only consist of the plaza index. Results, None for discarded plazas, are returned in the order of the plazas.
+    Workers only read from the result cache, new results are stored by this process, which keeps track of its size.
+    Workers are spawned instead of forked, since forking after osmium started its threads can deadlock
+    """
+    logger.info(f"Processing plazas with {workers} workers")
+    chunksize = max(1, len(osm_holder.plazas) // (workers * 4))
+    context = multiprocessing.get_context('spawn')
+    plaza_results = []
+    with context.Pool(
+            processes=workers, initializer=_init_worker,
+            initargs=(osm_holder, process_strategy, shortest_path_strategy, config, result_cache)) as pool:
+        for cache_key, processed_plaza in pool.imap(
+                _process_plaza_in_worker, range(len(osm_holder.plazas)), chunksize=chunksize):
+            if cache_key is not None:
+                _store_result(result_cache, cache_key, processed_plaza)
+            plaza_results.append(processed_plaza)
+    return plaza_results
+
+
+def _init_worker(osm_holder: OSMHolder, process_strategy: GraphProcessor, shortest_path_strategy, config: dict,
+                 result_cache=None):
+    """ create the preprocessor (and with it the spatial indices) once per worker process """
+    global _worker_preprocessor
+    _worker_preprocessor = PlazaPreprocessor(
+        osm_holder, process_strategy, shortest_path_strategy, config, result_cache)
+
+
+def _process_plaza_in_worker(plaza_index: int):
+    """
+    process the plaza with the given index with the preprocessor of this worker.
+    Returns the key the result has to be stored with in the result cache, if any, and the processed plaza
+    """
+    plaza = _worker_preprocessor.plazas[plaza_index]
+    logger.info(f"Processing plaza {plaza['osm_id']}")
+    return _worker_preprocessor._lookup_or_process_plaza(plaza)
+
+
+def _store_result(result_cache, cache_key, processed_plaza):
+    """ store the result of a plaza in the result cache, None for a discarded plaza """
+    if processed_plaza is None:
+        result_cache.put(cache_key, None)
+    else:
+        result_cache.put(cache_key, {name: processed_plaza[name] for name in RESULT_KEYS})
+
+
 class PlazaPreprocessor:
 
     def __init__(self, osm_holder: OSMHolder, graph_processor: GraphProcessor,
-                 shortest_path_strategy, config):
+                 shortest_path_strategy, config, result_cache=None):
         self.plazas = osm_holder.plazas
         self.lines = osm_holder.lines
         self.buildings = osm_holder.buildings
         self.points = osm_holder.points
+        self.spatial_index_dir = getattr(osm_holder, 'spatial_index_dir', None)
         self.graph_processor = graph_processor
         self.shortest_path_strategy = shortest_path_strategy
         self.config = config
+        self.result_cache = result_cache
 
         self._create_spatial_indices()
 
-    def process_plazas(self):
-        """ process all plazas in the osm holder"""
-        processed_plazas = []
-        for plaza in self.plazas:
-            logger.info(f"Processing plaza {plaza['osm_id']}")
-            processed_plaza = self._process_plaza(plaza)
-            if processed_plaza is not None:
-                processed_plazas.append(processed_plaza)
-
-        return processed_plazas
-
     def _create_spatial_indices(self):
-        """ create spatial indices for lines, buildings and points"""
-        logger.info("Creating spatial index for geometries")
-        line_geometries = [line['geometry'] for line in self.lines]
-        self.line_index = self._create_spatial_index(line_geometries)
-        self.building_index = self._create_spatial_index(self.buildings)
-        self.point_index = self._create_spatial_index(self.points)
+        """ create spatial indices for lines, buildings and points, or open the cached ones """
+        if self.spatial_index_dir:
+            logger.info(f"Opening spatial index for geometries in {self.spatial_index_dir}")
+            self.line_index = self._open_spatial_index('lines')
+            self.building_index = self._open_spatial_index('buildings')
+            self.point_index = self._open_spatial_index('points')
+        else:
+            logger.info("Creating spatial index for geometries")
+            line_geometries = [line['geometry'] for line in self.lines]
+            self.line_index = self._create_spatial_index(line_geometries)
+            self.building_index = self._create_spatial_index(self.buildings)
+            self.point_index = self._create_spatial_index(self.points)
+        self._query_plaza_bounds()
+
+    def _query_plaza_bounds(self):
+        """ query the bounds of all plazas at once in every spatial index """
+        self.plaza_bounds_matches = {}
+        plaza_bounds = [plaza['geometry'].bounds for plaza in self.plazas]
+        for index in (self.line_index, self.building_index, self.point_index):
+            for bounds, match_ids in zip(plaza_bounds, self._search_index_bulk(index, plaza_bounds)):
+                self.plaza_bounds_matches[(id(index), bounds)] = match_ids
 
     def _process_plaza(self, plaza):
-        """ process a single plaza """
+        """ process a single plaza, or take its result from the result cache """
+        cache_key, processed_plaza = self._lookup_or_process_plaza(plaza)
+        if cache_key is not None:
+            _store_result(self.result_cache, cache_key, processed_plaza)
+        return processed_plaza
 
+    def _lookup_or_process_plaza(self, plaza):
+        """
+        process a single plaza, or take its result from the result cache, without storing new results.
+        Returns the key the result has to be stored with, None if there is no cache or the result was cached,
+        and the processed plaza
+        """
         intersecting_lines = self._find_intersecting_lines(plaza['geometry'])
-
+        intersecting_buildings = self._find_intersecting_buildings(plaza['geometry'])
+        points_on_plaza = self._get_points_inside_plaza(plaza['geometry'])
+        if self.result_cache is None:
+            return None, self._process_plaza_with_geometries(
+                plaza, intersecting_lines, intersecting_buildings, points_on_plaza)
+
+        key = resultcache.plaza_result_key(
+            plaza, intersecting_lines, intersecting_buildings, points_on_plaza, self.config)
+        found, result = self.result_cache.get(key)
+        if found:
+            logger.debug(f"Plaza {plaza['osm_id']}: using cached result")
+            if result is None:
+                return None, None
+            plaza.update(result)
+            return None, plaza
+
+        return key, self._process_plaza_with_geometries(
+            plaza, intersecting_lines, intersecting_buildings, points_on_plaza)
+
+    def _process_plaza_with_geometries(self, plaza, intersecting_lines, intersecting_buildings, points_on_plaza):
+        """ process a single plaza with the lines, buildings and points intersecting it """
         plaza_geom_without_obstacles = self._calc_obstacle_geometry(
-            plaza, intersecting_lines, buffer_m=self.config['obstacle-buffer'])
+            plaza, intersecting_lines, buffer_m=self.config['obstacle-buffer'],
+            intersecting_buildings=intersecting_buildings, points_on_plaza=points_on_plaza)
 
         if not plaza_geom_without_obstacles:
             logger.debug(f"Discarding Plaza {plaza['osm_id']}: completely obstructed by obstacles")
@@ -96,7 +234,7 @@ class PlazaPreprocessor:
         """ create graph with shortest paths between entry points """
         graph_edges = self.graph_processor.create_graph_edges(plaza_geom_without_obstacles, entry_points)
 
-        graph = shortest_paths.create_graph(graph_edges)
+        graph = shortest_paths.create_graph_for_strategy(self.shortest_path_strategy, graph_edges)
         shortest_path_lines = self.shortest_path_strategy(graph, entry_points)
         optimized_lines = self.graph_processor.optimize_lines(
             plaza_geom, shortest_path_lines, self.config['obstacle-buffer'])
@@ -110,10 +248,7 @@ class PlazaPreprocessor:
         for line in intersecting_lines:
             line_geom = line['geometry']
             intersection = line_geom.intersection(plaza_geometry)
-            intersection_coords = intersection_coords.union(
-                utils.unpack_geometry_coordinates(intersection))
-
-        intersection_points = list(map(Point, intersection_coords))
+            intersection_coords.update(utils.unpack_geometry_coordinates(intersection))
 
         # define a buffer around the outer ring and check if the points are inside this buffer
         buffer_distance = utils.meters_to_degrees(lookup_buffer_m)
@@ -121,21 +256,22 @@ class PlazaPreprocessor:
         plaza_outer_buffer = plaza_geometry.exterior.buffer(
             buffer_distance, cap_style=CAP_STYLE.flat, join_style=JOIN_STYLE.mitre)
 
-        entry_points = [
-            p for p in intersection_points if plaza_outer_buffer.contains(p)]
+        intersection_coords = list(intersection_coords)
+        inside_buffer = utils.points_in_polygon(plaza_outer_buffer, intersection_coords)
+        entry_points = [Point(coords) for coords, inside in zip(intersection_coords, inside_buffer) if inside]
 
         return entry_points
 
     def _map_entry_lines(self, intersecting_lines, entry_points):
         """ map entry lines to entry points """
+        entry_point_ids = {(p.x, p.y): i for i, p in enumerate(entry_points)}
         entry_lines = []
         for line in intersecting_lines:
-            matching_entry_points = list(filter(
-                lambda p: (p.x, p.y) in line['geometry'].coords, entry_points))
-            if matching_entry_points:
+            matching_ids = {entry_point_ids[coords] for coords in line['geometry'].coords if coords in entry_point_ids}
+            if matching_ids:
                 entry_lines.append({
                     'way_id': line['id'],
-                    'entry_points': matching_entry_points
+                    'entry_points': [entry_points[i] for i in sorted(matching_ids)]
                 })
         return entry_lines
 
@@ -150,25 +286,29 @@ class PlazaPreprocessor:
 
         return intersecting_lines
 
-    def _calc_obstacle_geometry(self, plaza, intersecting_lines, buffer_m):
-        """ cuts out holes for obstacles on the plaza geometry """
-        intersecting_buildings = self._find_intersecting_buildings(plaza['geometry'])
-
-        geometry_without_buildings = plaza['geometry']
-        for building in intersecting_buildings:
-            geometry_without_buildings = geometry_without_buildings.difference(building)
-
-        points_on_plaza = self._get_points_inside_plaza(plaza['geometry'])
+    def _calc_obstacle_geometry(self, plaza, intersecting_lines, buffer_m, intersecting_buildings=None,
+                                points_on_plaza=None):
+        """
+        cuts out holes for obstacles on the plaza geometry.
+        The buildings and points on the plaza are looked up unless they are given
+        """
+        if intersecting_buildings is None:
+            intersecting_buildings = self._find_intersecting_buildings(plaza['geometry'])
+        if points_on_plaza is None:
+            points_on_plaza = self._get_points_inside_plaza(plaza['geometry'])
         point_obstacles = list(
             map(lambda p: self._create_point_obstacle(p, buffer_m), points_on_plaza))
 
         barrier_obstacles = self._create_barrier_obstacles(intersecting_lines, self.config['obstacle-buffer'] / 2)
 
-        geometry_without_obstacles = geometry_without_buildings
-        for point_obstacle in point_obstacles:
-            geometry_without_obstacles = geometry_without_obstacles.difference(point_obstacle)
-        for barrier_obstacle in barrier_obstacles:
-            geometry_without_obstacles = geometry_without_obstacles.difference(barrier_obstacle)
+        # a single difference with the union of all obstacles is much cheaper than
+        # cutting them out one by one, which rebuilds an increasingly complex polygon every time
+        start_time = time.perf_counter()
+        obstacles = unary_union(intersecting_buildings + point_obstacles + list(barrier_obstacles))
+        geometry_without_obstacles = plaza['geometry'].difference(obstacles)
+        elapsed_time_ms = (time.perf_counter() - start_time) * 1000
+        logger.debug(f"Plaza {plaza['osm_id']}: cut out {len(intersecting_buildings)} buildings, "
+                     f"{len(point_obstacles)} point obstacles and barriers in {elapsed_time_ms:.2f} milliseconds")
 
         if isinstance(geometry_without_obstacles, MultiPolygon):
             logger.debug(
@@ -196,20 +336,36 @@ class PlazaPreprocessor:
         return list(filter(plaza_geometry.intersects, potential_matches))
 
     def _create_spatial_index(self, geometries):
-        """ create rtree index for fast intersection checking """
+        """ create rtree index for fast intersection checking, bulk loaded from a stream """
         logger.debug(f"creating spatial index for {len(geometries)} geometries")
-        idx = rtree.index.Index()
-        for i, geometry in enumerate(geometries):
-            idx.insert(i, geometry.bounds)
-        return idx
+        if not geometries:
+            return rtree.index.Index()
+        return rtree.index.Index((i, geometry.bounds, None) for i, geometry in enumerate(geometries))
+
+    def _open_spatial_index(self, name):
+        """ open a rtree disk index created by the import cache """
+        return rtree.index.Index(path.join(self.spatial_index_dir, name))
 
     def _search_index(self, index, bounds, geometries):
         """
         search rtree index and return geometries that potentially
-        intersect with the bounds
+        intersect with the bounds. Uses the result of the bulk query if the bounds are those of a plaza
         """
-        potential_matches_indices = index.intersection(bounds)
-        return map(lambda i: geometries[i], potential_matches_indices)
+        potential_matches_indices = self.plaza_bounds_matches.get((id(index), bounds))
+        if potential_matches_indices is None:
+            potential_matches_indices = sorted(index.intersection(bounds))
+        return [geometries[i] for i in potential_matches_indices]
+
+    def _search_index_bulk(self, index, bounds_list):
+        """ search rtree index with many bounds and return the sorted ids of the potential matches for each """
+        if not bounds_list:
+            return []
+        if not hasattr(index, 'intersection_v'):
+            # bulk queries need Rtree 1.1
+            return [sorted(index.intersection(bounds)) for bounds in bounds_list]
+        bounds_array = np.array(bounds_list, dtype=float)
+        match_ids, counts = index.intersection_v(bounds_array[:, :2], bounds_array[:, 2:])
+        return [sorted(ids.tolist()) for ids in np.split(match_ids, np.cumsum(counts)[:-1])]
 
     def _create_point_obstacle(self, point, buffer_m):
         """ create a polygon around a point with a buffer in meters """
@@ -0,0 +1,49 @@
+"""
+State of a preprocessing run, used to process only changed plazas in the next run.
+The result of every plaza, or None if it was discarded, is stored with a key of its osm id and
+its geometry before processing
+"""
+import logging
+import os
+import pickle
+from typing import Dict, List, Tuple
+import rtree
+
+logger = logging.getLogger('plaza_preprocessing.optimizer')
+
+STATE_VERSION = 1
+
+
+def plaza_key(plaza) -> Tuple[int, bytes]:
+    """ key of an imported plaza, has to be created before the plaza is processed """
+    return plaza['osm_id'], plaza['geometry'].wkb
+
+
+def save_state(filename, plaza_results: Dict):
+    """ write the results of all plazas by their key, the file is replaced atomically """
+    temp_filename = f'{filename}.tmp'
+    with open(temp_filename, 'wb') as state_file:
+        pickle.dump({'version': STATE_VERSION, 'plazas': plaza_results}, state_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, filename)
+    logger.debug(f"Saved the state of {len(plaza_results)} plazas to {filename}")
+
+
+def load_state(filename) -> Dict:
+    """ read the results of all plazas by their key """
+    with open(filename, 'rb') as state_file:
+        state = pickle.load(state_file)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(f"{filename} was written by an incompatible version")
+    return state['plazas']
+
+
+def find_changed_plazas(plazas: List[dict], previous_results: Dict, changed_bounds: List[Tuple]) -> List[bool]:
+    """
+    check for every plaza if it has to be processed again, because it wasn't processed in the previous run
+    or because one of the changed objects intersects its bounds
+    """
+    if not changed_bounds:
+        return [plaza_key(plaza) not in previous_results for plaza in plazas]
+    changed_index = rtree.index.Index((i, bounds, None) for i, bounds in enumerate(changed_bounds))
+    return [plaza_key(plaza) not in previous_results or changed_index.count(plaza['geometry'].bounds) > 0
+            for plaza in plazas]
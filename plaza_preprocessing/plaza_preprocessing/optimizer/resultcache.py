@@ -0,0 +1,112 @@
+"""
+Size bounded on-disk cache for the results of single plazas.
+Entries are keyed by a hash of everything the result depends on, so unchanged plazas
+are not processed again in later runs. When the cache grows too large, the least recently
+used entries are removed
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+from os import path
+
+logger = logging.getLogger('plaza_preprocessing.optimizer')
+
+# increase when the processing changes in a way that invalidates cached results
+CACHE_VERSION = 1
+ENTRY_EXTENSION = '.pickle'
+# the result depends on every config value except the ones used to read the file and write the generated ways
+IGNORED_CONFIG_KEYS = {'footway-tags', 'location-index', 'location-index-file', 'node-deduplication'}
+
+
+class PlazaResultCache:
+    """
+    stores plaza results in cache_dir. The modification time of an entry is updated when it's read,
+    so the oldest entries are the least recently used ones. Any process can read entries, but only one should
+    store them, since the size of the cache is tracked by the storing process
+    """
+
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size_bytes = sum(size for _, _, size in self._entries())
+
+    def __getstate__(self):
+        # the size is read again from the cache directory
+        return {'cache_dir': self.cache_dir, 'max_size_bytes': self.max_size_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'], state['max_size_bytes'])
+
+    def get(self, key):
+        """ returns a tuple of whether the key was found and the cached result, which is None for discarded plazas """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                result = pickle.load(entry_file)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return False, None
+        except (EOFError, pickle.UnpicklingError):
+            logger.warning(f"Ignoring corrupt plaza result cache entry {entry_path}")
+            return False, None
+        return True, result
+
+    def put(self, key, result):
+        """ store the result and remove the least recently used entries if the cache is too large """
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.incomplete-')
+        with os.fdopen(file_descriptor, 'wb') as entry_file:
+            pickle.dump(result, entry_file, pickle.HIGHEST_PROTOCOL)
+        self.size_bytes += path.getsize(temp_path)
+        os.replace(temp_path, self._entry_path(key))
+        if self.size_bytes > self.max_size_bytes:
+            self._evict()
+
+    def _evict(self):
+        """ remove the least recently used entries until the cache is within its size """
+        entries = sorted(self._entries())
+        self.size_bytes = sum(size for _, _, size in entries)
+        for _, entry_path, size in entries:
+            if self.size_bytes <= self.max_size_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                # removed by another process
+                pass
+            self.size_bytes -= size
+        logger.debug(f"Evicted plaza results, cache size is now {self.size_bytes} bytes")
+
+    def _entries(self):
+        """ (last use, path, size) of all entries """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(ENTRY_EXTENSION):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _entry_path(self, key):
+        return path.join(self.cache_dir, key + ENTRY_EXTENSION)
+
+
+def plaza_result_key(plaza, intersecting_lines, buildings, points, config) -> str:
+    """ hash of the plaza, the geometries intersecting it and the config, which determine the result of a plaza """
+    key_hash = hashlib.sha256()
+    relevant_config = {key: value for key, value in config.items() if key not in IGNORED_CONFIG_KEYS}
+    key_hash.update(json.dumps({'version': CACHE_VERSION, 'config': relevant_config}, sort_keys=True).encode())
+    key_hash.update(str(plaza['osm_id']).encode())
+    key_hash.update(plaza['geometry'].wkb)
+    for line in intersecting_lines:
+        key_hash.update(json.dumps({'id': line['id'], 'tags': line['tags']}, sort_keys=True).encode())
+        key_hash.update(line['geometry'].wkb)
+    key_hash.update(f'{len(intersecting_lines)} {len(buildings)} {len(points)}'.encode())
+    for geometry in buildings + points:
+        key_hash.update(geometry.wkb)
+    return key_hash.hexdigest()
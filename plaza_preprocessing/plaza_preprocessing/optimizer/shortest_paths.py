@@ -1,6 +1,11 @@
 import logging
 import time
+from heapq import heapify, heappush, heappop
+from itertools import count
 import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
 from shapely.geometry import LineString, Point
 from typing import List, Tuple, Set, Dict
 
@@ -15,6 +20,67 @@ def create_graph(graph_edges: List[LineString]) -> nx.Graph:
     return graph
 
 
+class ArrayGraph:
+    """
+    compact graph with integer node ids. Node coordinates are stored in an array,
+    edges in a symmetric sparse adjacency matrix with the edge weights
+    """
+
+    def __init__(self, coords: np.ndarray, node_ids: Dict[Tuple[float, float], int], adjacency):
+        self.coords = coords
+        self.node_ids = node_ids
+        self.adjacency = adjacency
+
+    def number_of_nodes(self) -> int:
+        return len(self.node_ids)
+
+
+def create_array_graph(graph_edges: List[LineString]) -> ArrayGraph:
+    """ create an array backed graph with a collection of edges """
+    node_ids = {}
+    start_ids = []
+    end_ids = []
+    line_weights = {}
+    for i, line in enumerate(graph_edges):
+        line_coords = line.coords
+        start_ids.append(node_ids.setdefault(line_coords[0], len(node_ids)))
+        end_ids.append(node_ids.setdefault(line_coords[1], len(node_ids)))
+        if len(line_coords) > 2:
+            line_weights[i] = _calculate_weight_of_line(line)
+
+    coords = np.array(list(node_ids), dtype=float).reshape(-1, 2)
+    start_ids = np.array(start_ids, dtype=np.int64)
+    end_ids = np.array(end_ids, dtype=np.int64)
+    weights = np.hypot(*(coords[end_ids] - coords[start_ids]).T)
+    for i, weight in line_weights.items():
+        weights[i] = weight
+
+    # csgraph treats explicit zeros as missing edges, so loops are left out.
+    # Duplicate edges would be summed up, only the shortest of them is kept
+    is_edge = start_ids != end_ids
+    low_ids = np.minimum(start_ids, end_ids)[is_edge]
+    high_ids = np.maximum(start_ids, end_ids)[is_edge]
+    weights = weights[is_edge]
+    order = np.lexsort((weights, high_ids, low_ids))
+    low_ids, high_ids, weights = low_ids[order], high_ids[order], weights[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (low_ids[1:] != low_ids[:-1]) | (high_ids[1:] != high_ids[:-1])
+
+    size = len(node_ids)
+    adjacency = coo_matrix(
+        (np.concatenate([weights[first], weights[first]]),
+         (np.concatenate([low_ids[first], high_ids[first]]), np.concatenate([high_ids[first], low_ids[first]]))),
+        shape=(size, size)).tocsr()
+    return ArrayGraph(coords, node_ids, adjacency)
+
+
+def create_graph_for_strategy(shortest_path_strategy, graph_edges: List[LineString]):
+    """ create the graph that is used by the shortest path strategy """
+    if shortest_path_strategy is compute_sparse_dijkstra_shortest_paths:
+        return create_array_graph(graph_edges)
+    return create_graph(graph_edges)
+
+
 def compute_dijkstra_shortest_paths(graph: nx.Graph, entry_points: List[Point]) -> List[LineString]:
     """
     compute a list of shortest paths as LineStrings between all pairs of entry points
@@ -53,6 +119,181 @@ def compute_astar_shortest_paths(graph: nx.Graph, entry_points: List[Point]) ->
     return lines
 
 
+def compute_entry_point_dijkstra_shortest_paths(graph: nx.Graph, entry_points: List[Point]) -> List[LineString]:
+    """
+    compute a list of shortest paths as LineStrings between all pairs of entry points
+    using the dijkstra algorithm. Only searches from the entry points and stops
+    as soon as the shortest paths to all other entry points are known
+    """
+    entry_coords = list(map(lambda point: (point.x, point.y), entry_points))
+    lines = []
+    start_time = time.perf_counter()
+    for start_node in entry_coords:
+        end_nodes = [end_node for end_node in entry_coords if start_node < end_node]
+        if not end_nodes:
+            continue
+        if start_node not in graph:
+            logger.warning(f"entry point {start_node} is not reachable on the graph, discarding paths")
+            continue
+        paths = _dijkstra_paths_to_targets(graph, start_node, set(end_nodes))
+        for end_node in end_nodes:
+            if end_node not in paths:
+                logger.debug(f"entry point {end_node} is not reachable from {start_node}, discarding path")
+                continue
+            lines.append(LineString(paths[end_node]))
+    end_time = time.perf_counter()
+    elapsed_time_ms = (end_time - start_time) * 1000
+    logger.debug(f"computed dijkstra shortest paths from entry points in {elapsed_time_ms:.2f} milliseconds")
+    return lines
+
+
+def compute_sparse_dijkstra_shortest_paths(graph: ArrayGraph, entry_points: List[Point]) -> List[LineString]:
+    """
+    compute a list of shortest paths as LineStrings between all pairs of entry points
+    using the dijkstra algorithm of scipy on an array backed graph, only searching from the entry points
+    """
+    entry_coords = list(map(lambda point: (point.x, point.y), entry_points))
+    start_time = time.perf_counter()
+    reachable_coords = []
+    for coords in entry_coords:
+        if coords in graph.node_ids:
+            reachable_coords.append(coords)
+        else:
+            logger.warning(f"entry point {coords} is not reachable on the graph, discarding paths")
+
+    lines = []
+    if reachable_coords:
+        entry_ids = [graph.node_ids[coords] for coords in reachable_coords]
+        distances, predecessors = dijkstra(
+            graph.adjacency, directed=False, indices=entry_ids, return_predecessors=True)
+        for source, start_node in enumerate(reachable_coords):
+            for end_node in reachable_coords:
+                if start_node < end_node:
+                    end_id = graph.node_ids[end_node]
+                    if np.isinf(distances[source, end_id]):
+                        logger.debug(f"entry point {end_node} is not reachable from {start_node}, discarding path")
+                        continue
+                    path = _follow_predecessors(predecessors[source], end_id)
+                    lines.append(LineString(graph.coords[path]))
+    end_time = time.perf_counter()
+    elapsed_time_ms = (end_time - start_time) * 1000
+    logger.debug(f"computed sparse dijkstra shortest paths in {elapsed_time_ms:.2f} milliseconds")
+    return lines
+
+
+def _follow_predecessors(predecessors: np.ndarray, end_id: int) -> List[int]:
+    """ returns the ids of the nodes on the path to the end node, starting at the source """
+    path = [end_id]
+    predecessor = predecessors[end_id]
+    while predecessor >= 0:
+        path.append(predecessor)
+        predecessor = predecessors[predecessor]
+    return path[::-1]
+
+
+def _dijkstra_paths_to_targets(graph: nx.Graph, source, targets: Set) -> Dict:
+    """ single source dijkstra that stops as soon as all targets are settled, returns the paths to the targets """
+    distances = {}
+    predecessors = {source: None}
+    remaining_targets = set(targets)
+    counter = count()
+    queue = [(0, next(counter), source)]
+    seen = {source: 0}
+    while queue and remaining_targets:
+        distance, _, node = heappop(queue)
+        if node in distances:
+            continue
+        distances[node] = distance
+        remaining_targets.discard(node)
+        for neighbor, edge_attributes in graph.adj[node].items():
+            neighbor_distance = distance + edge_attributes.get('weight', 1)
+            if neighbor not in distances and (neighbor not in seen or neighbor_distance < seen[neighbor]):
+                seen[neighbor] = neighbor_distance
+                predecessors[neighbor] = node
+                heappush(queue, (neighbor_distance, next(counter), neighbor))
+
+    paths = {}
+    for target in targets:
+        if target not in distances:
+            continue
+        path = [target]
+        while predecessors[path[-1]] is not None:
+            path.append(predecessors[path[-1]])
+        paths[target] = path[::-1]
+    return paths
+
+
+def compute_shared_astar_shortest_paths(graph: nx.Graph, entry_points: List[Point]) -> List[LineString]:
+    """
+    compute a list of shortest paths as LineStrings between all pairs of entry points
+    using the astar algorithm. The search state of an entry point is shared by the searches
+    for all of its paths, nodes settled for one target are not searched again for the next one
+    """
+    entry_coords = list(map(lambda point: (point.x, point.y), entry_points))
+    lines = []
+    start_time = time.perf_counter()
+    for start_node in entry_coords:
+        end_nodes = [end_node for end_node in entry_coords if start_node < end_node]
+        if not end_nodes:
+            continue
+        if start_node not in graph:
+            logger.debug(f"entry point {start_node} is not on the graph, discarding paths")
+            continue
+        paths = _shared_astar_paths(graph, start_node, end_nodes)
+        for end_node in end_nodes:
+            if end_node not in paths:
+                logger.debug(f"no path between {start_node} and {end_node}, discarding path")
+                continue
+            lines.append(LineString(paths[end_node]))
+    end_time = time.perf_counter()
+    elapsed_time_ms = (end_time - start_time) * 1000
+    logger.debug(f"computed shortest paths with shared astar in {elapsed_time_ms:.2f} milliseconds")
+    return lines
+
+
+def _shared_astar_paths(graph: nx.Graph, source, targets: List) -> Dict:
+    """
+    astar searches from the source to every target, which continue with the settled nodes and the
+    frontier of the previous search. The heuristic is consistent, so settled distances stay exact
+    when the frontier is reordered for the next target
+    """
+    distances = {source: 0}
+    predecessors = {source: None}
+    settled = set()
+    counter = count()
+    for target in sorted(targets, key=lambda t: _distance_between_nodes(source, t)):
+        if target in settled or target not in graph:
+            continue
+        queue = [(distance + _distance_between_nodes(node, target), next(counter), node, distance)
+                 for node, distance in distances.items() if node not in settled]
+        heapify(queue)
+        while queue:
+            _, _, node, distance = heappop(queue)
+            if node in settled or distance > distances[node]:
+                continue
+            settled.add(node)
+            # neighbors are updated before stopping, so the frontier is complete for the next target
+            for neighbor, edge_attributes in graph.adj[node].items():
+                neighbor_distance = distance + edge_attributes.get('weight', 1)
+                if neighbor not in settled and neighbor_distance < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = neighbor_distance
+                    predecessors[neighbor] = node
+                    heappush(queue, (neighbor_distance + _distance_between_nodes(neighbor, target),
+                                     next(counter), neighbor, neighbor_distance))
+            if node == target:
+                break
+
+    paths = {}
+    for target in targets:
+        if target not in settled:
+            continue
+        path = [target]
+        while predecessors[path[-1]] is not None:
+            path.append(predecessors[path[-1]])
+        paths[target] = path[::-1]
+    return paths
+
+
 def _extract_lines_between_entry_points(shortest_paths: Dict, entry_coords: List[Tuple]) -> List[LineString]:
     """ create shortest lines between every pair of entry points"""
     lines = []
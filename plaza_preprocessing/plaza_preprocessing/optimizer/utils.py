@@ -1,6 +1,8 @@
 import logging
 import time
-from shapely.geometry import Point, MultiPoint, LineString, MultiLineString, GeometryCollection
+import numpy as np
+from shapely.geometry import Point, MultiPoint, LineString, MultiLineString, GeometryCollection, JOIN_STYLE
+from shapely.prepared import prep
 
 logger = logging.getLogger('plaza_preprocessing.optimizer')
 
@@ -11,10 +13,10 @@ def unpack_geometry_coordinates(geometry):
     if geom_type == GeometryCollection:
         coords = set()
         for geom in geometry:
-            coords = coords.union(unpack_geometry_coordinates(geom))
+            coords.update(unpack_geometry_coordinates(geom))
         return coords
     elif geom_type == MultiLineString or geom_type == MultiPoint:
-        return set().union([c for element in geometry for c in element.coords])
+        return {c for element in geometry.geoms for c in element.coords}
     elif geom_type == LineString or geom_type == Point:
         return set(geometry.coords)
     else:
@@ -36,6 +38,26 @@ def get_polygon_coords(polygon):
     return coords
 
 
+def points_in_polygon(polygon, coords):
+    """
+    return a boolean array telling for each coordinate pair whether it lies inside the polygon (or multipolygon).
+    All points are tested against all edges at once with the even-odd rule, points on the boundary may go either way
+    """
+    points = np.asarray(coords, dtype=float).reshape(-1, 2)
+    x, y = points[:, :1], points[:, 1:]
+    inside = np.zeros(len(points), dtype=bool)
+    for part in getattr(polygon, 'geoms', [polygon]):
+        for ring in [part.exterior, *part.interiors]:
+            ring_coords = np.asarray(ring.coords)
+            start, end = ring_coords[:-1], ring_coords[1:]
+            # edges crossing the horizontal line through a point, horizontal edges never do
+            crossing = (start[:, 1] > y) != (end[:, 1] > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crossing_x = start[:, 0] + (y - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+            inside ^= np.count_nonzero(crossing & (x < crossing_x), axis=1) % 2 == 1
+    return inside
+
+
 def find_nearest_geometry(obj, geometries):
     """ return the geometry that is nearest to the object """
     return min(geometries, key=lambda g: g.distance(obj))
@@ -50,6 +72,28 @@ def line_visible(plaza_geometry, line, delta_m):
     return abs(line.length - intersection_line.length) <= delta
 
 
+class VisibilityChecker:
+    """
+    checks the visibility of many lines on the same plaza.
+    Gives the same result as line_visible, but rejects most invisible lines with a
+    prepared geometry before the expensive intersection is computed
+    """
+
+    def __init__(self, plaza_geometry, delta_m):
+        self.plaza_geometry = plaza_geometry
+        self.delta_m = delta_m
+        # every point outside of this buffer is farther than delta away from the plaza,
+        # so a line leaving it runs outside the plaza for longer than delta
+        plaza_buffer = plaza_geometry.buffer(meters_to_degrees(delta_m), join_style=JOIN_STYLE.mitre)
+        self.prepared_plaza_buffer = prep(plaza_buffer)
+
+    def line_visible(self, line):
+        """ check if the line is "visible", i.e. unobstructed through the plaza"""
+        if not self.prepared_plaza_buffer.covers(line):
+            return False
+        return line_visible(self.plaza_geometry, line, self.delta_m)
+
+
 def timing(f):
     """ decorator function to measure runtime of a function """
     def wrap(*args):
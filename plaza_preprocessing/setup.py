@@ -15,7 +15,7 @@ setup(
     url='https://github.com/PlazaRoute/plazaroute',
     license="MIT License",
     packages=find_packages(exclude=('tests', 'docs')),
-    install_requires=['osmium', 'Shapely', 'geojson', 'networkx', 'Rtree', 'jsonschema', 'ruamel.yaml'],
+    install_requires=['osmium', 'Shapely', 'geojson', 'networkx', 'Rtree', 'jsonschema', 'ruamel.yaml', 'numpy', 'scipy'],
     entry_points={
         'console_scripts': [
             'plaza_preprocessing=plaza_preprocessing.__main__:plaza_preprocessing'
@@ -0,0 +1,70 @@
+"""
+Benchmarks compare the run time of two implementations on the larger test files.
+They are marked with benchmark and only run with --benchmark, their results are listed at the end of the session
+"""
+import pytest
+import utils
+
+_results = []
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help='run the tests marked with benchmark')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing run, skipped unless --benchmark is given')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip_benchmark = pytest.mark.skip(reason='benchmarks only run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section('benchmark results')
+    for test_name, label, result in _results:
+        terminalreporter.write_line(f'{test_name} {label}: {result}')
+
+
+@pytest.fixture
+def benchmark_result(request):
+    """
+    returns a function recording a result of the test under label with --benchmark, e.g. a peak memory.
+    Without it, results are dropped, so tests record them on small inputs as well
+    """
+    def record(label, result):
+        if request.config.getoption('--benchmark'):
+            _results.append((request.node.name, label, result))
+    return record
+
+
+@pytest.fixture
+def timed(benchmark_result):
+    """
+    returns a function calling function(*args, **kwargs) and recording its run time under label.
+    Tests comparing two implementations call both through it, on small inputs and on the benchmark inputs,
+    and record the ratio of their run times with its speedup function. The run times in seconds by label
+    are kept in its elapsed_times
+    """
+    elapsed_times = {}
+
+    def timed_call(label, function, *args, **kwargs):
+        result, elapsed_times[label] = utils.call_timed(function, *args, **kwargs)
+        benchmark_result(label, utils.format_ms(elapsed_times[label]))
+        return result
+
+    def speedup(before_label, after_label):
+        """ record how many times faster the call under after_label was than the one under before_label """
+        benchmark_result(f'{before_label} / {after_label}',
+                         f'{elapsed_times[before_label] / elapsed_times[after_label]:.1f}x')
+
+    timed_call.speedup = speedup
+    timed_call.elapsed_times = elapsed_times
+    return timed_call
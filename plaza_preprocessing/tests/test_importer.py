@@ -1,7 +1,12 @@
+import multiprocessing
 import os
+import resource
 import pytest
 import testfilemanager
+import utils
 from plaza_preprocessing import configuration
+from plaza_preprocessing.importer import importer, importcache, changes
+from plaza_preprocessing.importer.geometryfactory import GeometryFactory, HexWKBGeometryFactory
 
 
 @pytest.fixture
@@ -54,5 +59,187 @@ def test_relation_with_unclosed_ways(config):
     assert len(holder.plazas) == 1
 
 
+def test_low_memory_import(config):
+    """ only geometries within the bounds of a plaza should be imported """
+    holder = testfilemanager.import_testfile('bahnhofplatz_bern', config)
+    low_memory_holder = testfilemanager.import_testfile('bahnhofplatz_bern', config, low_memory=True)
+
+    assert [p['osm_id'] for p in low_memory_holder.plazas] == [p['osm_id'] for p in holder.plazas]
+    assert len(low_memory_holder.lines) < len(holder.lines)
+    assert len(low_memory_holder.buildings) < len(holder.buildings)
+    assert len(low_memory_holder.points) < len(holder.points)
+
+    plaza_geometries = [p['geometry'] for p in holder.plazas]
+    expected_line_ids = [
+        line['id'] for line in holder.lines
+        if any(plaza.intersects(line['geometry']) for plaza in plaza_geometries)]
+    assert all(line_id in [line['id'] for line in low_memory_holder.lines] for line_id in expected_line_ids)
+
+
+@pytest.mark.parametrize('low_memory', [False, True])
+def test_line_nodes_near_plazas(config, low_memory):
+    """ only lines near a plaza should keep their nodes, all lines intersecting a plaza have them """
+    holder = testfilemanager.import_testfile('bahnhofplatz_bern', config, low_memory=low_memory)
+
+    plaza_geometries = [p['geometry'] for p in holder.plazas]
+    intersecting_lines = [
+        line for line in holder.lines if any(plaza.intersects(line['geometry']) for plaza in plaza_geometries)]
+    assert intersecting_lines
+    assert all(len(line['node_refs']) * 2 == len(line['node_coords']) == len(line['geometry'].coords) * 2
+               for line in intersecting_lines)
+    if not low_memory:
+        assert any('node_refs' not in line for line in holder.lines)
+
+
+@pytest.mark.parametrize('testfile', [
+    'kreuzplatz',
+    pytest.param('bahnhofplatz_bern', marks=pytest.mark.benchmark),
+    pytest.param('bundeshaus_bern', marks=pytest.mark.benchmark),
+    pytest.param('bahnhofstrasse', marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', marks=pytest.mark.benchmark)])
+def test_geometry_factory(testfile, config, timed, benchmark_result):
+    """ the geometry factory should create the same geometries as parsing hex WKB """
+    hex_handler = timed('HexWKBGeometryFactory', _import_with_factory, testfile, HexWKBGeometryFactory(), config)
+    handler = timed('GeometryFactory', _import_with_factory, testfile, GeometryFactory(), config)
+    _assert_same_geometries(hex_handler, handler)
+    object_count = len(handler.plazas) + len(handler.buildings) + len(handler.lines) + len(handler.points)
+    for label, elapsed_time in timed.elapsed_times.items():
+        benchmark_result(f'{label} throughput', f'{object_count / elapsed_time:.0f} objects/s')
+
+
+def _import_with_factory(testfile, factory, config):
+    handler = importer._PlazaHandler(config['tag-filter'], geometry_factory=factory)
+    handler.apply_file(testfilemanager.get_testfile_name(testfile), locations=True, idx='sparse_mem_array')
+    return handler
+
+
+def _assert_same_geometries(hex_handler, handler):
+    assert len(hex_handler.plazas) == len(handler.plazas) > 0
+    assert all(hex_plaza['geometry'].equals_exact(plaza['geometry'], 0)
+               for hex_plaza, plaza in zip(hex_handler.plazas, handler.plazas))
+    assert len(hex_handler.buildings) == len(handler.buildings)
+    assert all(hex_building.equals_exact(building, 0)
+               for hex_building, building in zip(hex_handler.buildings, handler.buildings))
+    assert len(hex_handler.lines) == len(handler.lines)
+    assert all(hex_line['geometry'].equals_exact(line['geometry'], 0)
+               for hex_line, line in zip(hex_handler.lines, handler.lines))
+    assert len(hex_handler.points) == len(handler.points)
+    assert all(hex_point.equals_exact(point, 0) for hex_point, point in zip(hex_handler.points, handler.points))
+
+
+# dense indices are left out, they are sized by the largest node id and only pay off for planet files
+SPARSE_LOCATION_INDICES = ['sparse_mem_array', 'sparse_mem_map', 'sparse_mmap_array', 'sparse_file_array', 'flex_mem']
+
+
+def test_sparse_location_indices(config, tmpdir):
+    """ importing with any sparse location index should give the same lines """
+    filename = testfilemanager.get_testfile_name('kreuzplatz')
+    index_file = str(tmpdir.join('locations.idx'))
+    expected_lines = None
+    for index_type in SPARSE_LOCATION_INDICES:
+        location_index = importer.location_index(index_type, index_file)
+        holder = importer.import_osm(filename, config['tag-filter'], location_index=location_index)
+        lines = [(line['id'], line['geometry'].wkb, line['node_refs'].tolist() if 'node_refs' in line else None)
+                 for line in holder.lines]
+        if expected_lines is None:
+            expected_lines = lines
+        assert lines == expected_lines
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('testfile', ['bahnhofplatz_bern', 'zuerich_hb'])
+def test_location_index_benchmark(testfile, config, tmpdir, benchmark_result):
+    """ compare time and peak memory of importing with the sparse location indices """
+    index_file = str(tmpdir.join('locations.idx'))
+    context = multiprocessing.get_context('spawn')
+    for index_type in SPARSE_LOCATION_INDICES:
+        location_index = importer.location_index(index_type, index_file)
+        # every import runs in a new process to measure its peak memory
+        with context.Pool(1) as pool:
+            elapsed_time, max_rss_kb = pool.apply(
+                _timed_import, (testfilemanager.get_testfile_name(testfile), config['tag-filter'], location_index))
+        benchmark_result(index_type, f"{utils.format_ms(elapsed_time)}, peak memory {max_rss_kb // 1024} MB")
+
+
+def _timed_import(filename, tag_filters, location_index):
+    _, elapsed_time = utils.call_timed(importer.import_osm, filename, tag_filters, location_index=location_index)
+    return elapsed_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def test_location_index_file(config, tmpdir):
+    """ the importer should remove the index file it created, but never a file that already existed """
+    filename = testfilemanager.get_testfile_name('kreuzplatz')
+    index_file = tmpdir.join('locations.idx')
+    location_index = importer.location_index('sparse_file_array', str(index_file))
+    importer.import_osm(filename, config['tag-filter'], low_memory=True, location_index=location_index)
+    assert not index_file.exists()
+
+    index_file.write('not an index')
+    with pytest.raises(FileExistsError):
+        importer.import_osm(filename, config['tag-filter'], location_index=location_index)
+    assert index_file.read() == 'not an index'
+
+
+def test_location_index():
+    assert importer.location_index() == 'sparse_mem_array'
+    assert importer.location_index('flex_mem', 'ignored.idx') == 'flex_mem'
+    assert importer.location_index('sparse_file_array', 'locations.idx') == 'sparse_file_array,locations.idx'
+    with pytest.raises(ValueError):
+        importer.location_index('dense_file_array')
+
+
 def get_plazas_by_id(plazas, osm_id):
     return list(filter(lambda p: p['osm_id'] == osm_id, plazas))
+
+
+@pytest.mark.parametrize('testfile', ['kreuzplatz', pytest.param('bahnhofstrasse', marks=pytest.mark.benchmark)])
+def test_import_cache(testfile, config, tmpdir, monkeypatch, timed):
+    """ a cached import should give the same holder without importing the file again """
+    filename = testfilemanager.get_testfile_name(testfile)
+    expected = importer.import_osm(filename, config['tag-filter'])
+    timed('import', importcache.import_osm_cached, filename, config['tag-filter'], str(tmpdir))
+
+    def fail_import(*args, **kwargs):
+        raise AssertionError('file imported again')
+    monkeypatch.setattr(importer, 'import_osm', fail_import)
+
+    holder = timed('from cache', importcache.import_osm_cached, filename, config['tag-filter'], str(tmpdir))
+    assert holder.spatial_index_dir
+    assert [p['osm_id'] for p in holder.plazas] == [p['osm_id'] for p in expected.plazas]
+    assert all(p['geometry'].equals_exact(e['geometry'], 0) for p, e in zip(holder.plazas, expected.plazas))
+    assert [(l['id'], l['tags']) for l in holder.lines] == [(l['id'], l['tags']) for l in expected.lines]
+    assert [(l['version'], l.get('node_refs'), l.get('node_coords')) for l in holder.lines] == \
+        [(l['version'], l.get('node_refs'), l.get('node_coords')) for l in expected.lines]
+    assert all(l['geometry'].equals_exact(e['geometry'], 0) for l, e in zip(holder.lines, expected.lines))
+    assert len(holder.buildings) == len(expected.buildings)
+    assert all(b.equals_exact(e, 0) for b, e in zip(holder.buildings, expected.buildings))
+    assert len(holder.points) == len(expected.points)
+    assert all(p.equals_exact(e, 0) for p, e in zip(holder.points, expected.points))
+
+
+def test_import_cache_key(config):
+    filename = testfilemanager.get_testfile_name('bahnhofstrasse')
+    key = importcache.cache_key(filename, config['tag-filter'])
+    assert key == importcache.cache_key(filename, config['tag-filter'])
+    assert key != importcache.cache_key(testfilemanager.get_testfile_name('kreuzplatz'), config['tag-filter'])
+    assert key != importcache.cache_key(filename, config['tag-filter'], low_memory=True)
+
+    tag_filters = dict(config['tag-filter'])
+    tag_filters['barrier'] = {'barrier': ['wall']}
+    assert key != importcache.cache_key(filename, tag_filters)
+
+
+def test_changed_bounds(config, tmpdir):
+    filename = testfilemanager.get_testfile_name('bahnhofstrasse')
+    holder = importer.import_osm(filename, config['tag-filter'])
+    plaza = get_plazas_by_id(holder.plazas, 27405455)[0]
+    line = next(line for line in holder.lines if plaza['geometry'].intersects(line['geometry']))
+    change_file = tmpdir.join('changes.osc')
+    change_file.write(f'<osmChange version="0.6"><modify><way id="{line["id"]}" version="99"/></modify></osmChange>')
+
+    changed_ids = changes.read_changes(str(change_file))
+    assert changed_ids.ways == {line['id']}
+    assert not changed_ids.nodes and not changed_ids.relations
+
+    changed_bounds = changes.changed_bounds(filename, changed_ids)
+    assert changed_bounds == [pytest.approx(line['geometry'].bounds)]
@@ -1,8 +1,12 @@
+import osmium
 import pytest
 import os
 import testfilemanager
 from os import path, remove
 from plaza_preprocessing import __main__, configuration
+from plaza_preprocessing.importer import importer, changes
+from plaza_preprocessing.merger import merger
+from plaza_preprocessing.optimizer import optimizer
 
 
 @pytest.fixture
@@ -20,3 +24,120 @@ def test_main(config):
         assert path.exists(out_file)
     finally:
         remove(out_file)
+
+
+def test_parse_workers():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    workers = __main__.parse_args([testfile, 'out.osm', '--workers', '4']).workers
+    assert workers == 4
+
+
+def test_parse_invalid_workers():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    with pytest.raises(SystemExit):
+        __main__.parse_args([testfile, 'out.osm', '--workers', '0'])
+
+
+def test_parse_low_memory():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    low_memory = __main__.parse_args([testfile, 'out.osm', '--low-memory']).low_memory
+    assert low_memory
+
+
+def test_parse_cache_dir():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    assert __main__.parse_args([testfile, 'out.osm']).cache_dir is None
+    cache_dir = __main__.parse_args([testfile, 'out.osm', '--cache-dir', 'cache']).cache_dir
+    assert cache_dir == 'cache'
+
+
+def test_parse_location_index():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    args = __main__.parse_args([testfile, 'out.osm'])
+    assert args.location_index is None
+    args = __main__.parse_args(
+        [testfile, 'out.osm', '--location-index', 'sparse_file_array', '--location-index-file', 'locations.idx'])
+    assert args.location_index == 'sparse_file_array'
+    assert args.location_index_file == 'locations.idx'
+    with pytest.raises(SystemExit):
+        __main__.parse_args([testfile, 'out.osm', '--location-index', 'unknown'])
+
+
+def test_parse_result_cache():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    args = __main__.parse_args([testfile, 'out.osm'])
+    assert args.result_cache is None
+    assert args.result_cache_size == 1024
+    args = __main__.parse_args([testfile, 'out.osm', '--result-cache', 'results', '--result-cache-size', '10'])
+    assert args.result_cache == 'results'
+    assert args.result_cache_size == 10
+
+
+def test_parse_changes_requires_state():
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    with pytest.raises(SystemExit):
+        __main__.parse_args([testfile, 'out.osm', '--reprocess-changes', testfile])
+    args = __main__.parse_args(
+        [testfile, 'out.osm', '--reprocess-changes', testfile, '--state', 'plazas.state', '--previous-output', testfile])
+    assert args.reprocess_changes == testfile
+
+
+def test_reprocess_changed_plazas(config, tmpdir, monkeypatch):
+    """ without changes, no plaza should be processed again and the merged plazas should be the same """
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    state_file = str(tmpdir.join('plazas.state'))
+    change_file = tmpdir.join('changes.osc')
+    change_file.write('<osmChange version="0.6"></osmChange>')
+    first_output = str(tmpdir.join('first.osm'))
+    merged_plazas = []
+    merge_plaza_graphs = merger.merge_plaza_graphs
+
+    def record_merged_plazas(plazas, *args, **kwargs):
+        merged_plazas.append(plazas)
+        return merge_plaza_graphs(plazas, *args, **kwargs)
+    monkeypatch.setattr(merger, 'merge_plaza_graphs', record_merged_plazas)
+
+    __main__.preprocess_osm(testfile, first_output, config, state_file=state_file)
+    processed_plazas = []
+    process_plaza_results = optimizer.process_plaza_results
+
+    def record_processed_plazas(holder, *args):
+        processed_plazas.extend(holder.plazas)
+        return process_plaza_results(holder, *args)
+    monkeypatch.setattr(optimizer, 'process_plaza_results', record_processed_plazas)
+    __main__.preprocess_osm(testfile, str(tmpdir.join('second.osm')), config, state_file=state_file,
+                            change_file=str(change_file), previous_output=first_output)
+
+    assert not processed_plazas
+    assert len(merged_plazas[1]) == len(merged_plazas[0]) > 0
+    assert [p['osm_id'] for p in merged_plazas[1]] == [p['osm_id'] for p in merged_plazas[0]]
+
+
+def test_changed_bounds_of_previous_output(config, tmpdir):
+    """ ways with generated entry nodes in the previous output keep their bounds """
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    output = str(tmpdir.join('out.osm'))
+    __main__.preprocess_osm(testfile, output, config)
+    holder = importer.import_osm(testfile, config['tag-filter'])
+    entry_way_ids = _ways_with_generated_nodes(output)
+    lines = [line for line in holder.lines if line['id'] in entry_way_ids]
+    assert lines
+
+    changed_ids = changes.ChangedIds(set(), {line['id'] for line in lines}, set())
+    changed_bounds = changes.changed_bounds(output, changed_ids)
+
+    assert sorted(changed_bounds) == sorted(pytest.approx(line['geometry'].bounds) for line in lines)
+
+
+def _ways_with_generated_nodes(filename):
+    class WayCollector(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.way_ids = set()
+
+        def way(self, way):
+            if way.id > 0 and any(n.ref < 0 for n in way.nodes):
+                self.way_ids.add(way.id)
+    collector = WayCollector()
+    collector.apply_file(filename)
+    return collector.way_ids
@@ -1,12 +1,18 @@
 import os.path
+import shutil
 import pytest
+import numpy as np
+from osmium import SimpleHandler
+from osmium.osm import Location
 from shapely.geometry import LineString, Point
 import testfilemanager
 import utils
-from plaza_preprocessing.optimizer import shortest_paths
+from plaza_preprocessing.optimizer import optimizer, shortest_paths
 from plaza_preprocessing import configuration
+from plaza_preprocessing.importer import importer
 import plaza_preprocessing.merger.merger as merger
 import plaza_preprocessing.merger.plazatransformer as plazatransformer
+import plaza_preprocessing.merger.streammerger as streammerger
 from plaza_preprocessing.optimizer.graphprocessor.spiderwebgraph import SpiderWebGraphProcessor
 from plaza_preprocessing.optimizer.graphprocessor.visibilitygraph import VisibilityGraphProcessor
 
@@ -39,18 +45,126 @@ def test_transform_plaza():
     plaza = create_test_plaza()
     plaza_transformer.transform_plaza(plaza)
     assert len(plaza_transformer.nodes) == 4
-    assert len(plaza_transformer.ways) == 2
-    assert plaza_transformer.ways[1].nodes[2] == plaza_transformer.ways[0].nodes[1]
+    assert len(plaza_transformer.output.ways) == 2
+    assert plaza_transformer.output.ways[1].nodes[2] == plaza_transformer.output.ways[0].nodes[1]
     assert len(plaza_transformer.entry_node_mappings[99]) == 1
 
 
+def test_transform_plazas_sharing_entry_way(config):
+    """ entry nodes of a way shared by two plazas should be kept for both of them """
+    plaza = create_test_plaza()
+    other_plaza = create_test_plaza()
+    other_plaza['entry_lines'][0]['entry_points'] = [Point(0, 1)]
+    _, _, entry_node_mappings = plazatransformer.create_plaza_objects([plaza, other_plaza], config['footway-tags'])
+    assert [node['coords'] for node in entry_node_mappings[99]] == [(0, 0), (0, 1)]
+    assert len({node['id'] for node in entry_node_mappings[99]}) == 2
+    assert len(entry_node_mappings[98]) == 2
+
+
+@pytest.mark.parametrize('count', [200, pytest.param(20000, marks=pytest.mark.benchmark)])
+def test_transform_many_plazas(count, config, timed):
+    """ collecting the entry node mappings should take linear time in the number of plazas """
+    plazas = []
+    for i in range(count):
+        plaza = create_test_plaza()
+        for j, entry_line in enumerate(plaza['entry_lines']):
+            entry_line['way_id'] = 2 * i + j
+        plazas.append(plaza)
+
+    nodes, ways, entry_node_mappings = timed(
+        'transforming', plazatransformer.create_plaza_objects, plazas, config['footway-tags'])
+    # merging by copying the mappings after every plaza, like before
+    copied_mappings = timed('copying the mappings alone', _copy_mappings_per_plaza, entry_node_mappings, count)
+    assert len(entry_node_mappings) == 2 * len(plazas)
+    assert len(nodes) == 4 * len(plazas)
+    assert len(ways) == 2 * len(plazas)
+    assert copied_mappings == entry_node_mappings
+
+
+def _copy_mappings_per_plaza(entry_node_mappings, count):
+    copied_mappings = {}
+    for i in range(count):
+        copied_mappings = {**copied_mappings, 2 * i: entry_node_mappings[2 * i], 2 * i + 1: entry_node_mappings[2 * i + 1]}
+    return copied_mappings
+
+
+@pytest.mark.parametrize('counts', [(1000, 6000), pytest.param((2000, 8000, 32000), marks=pytest.mark.benchmark)])
+def test_transform_plazas_memory(counts, config, tmpdir, timed, benchmark_result):
+    """ writing the generated nodes and ways to files should take the same memory for any number of plazas """
+    plaza = create_test_plaza()
+    plaza['entry_lines'] = []
+    peaks = []
+    for count in counts:
+        node_file = str(tmpdir.join(f'nodes-{count}.osm.pbf'))
+        way_file = str(tmpdir.join(f'ways-{count}.osm.pbf'))
+        _, peak = utils.call_traced(timed, f'{count} plazas', plazatransformer.transform_plazas,
+                                    [plaza] * count, node_file, way_file, config['footway-tags'])
+        peaks.append(peak)
+        benchmark_result(f'{count} plazas peak memory', f'{peaks[-1] // 1024} kB')
+
+        nodes, ways, _ = plazatransformer.create_plaza_objects([plaza] * count, config['footway-tags'])
+        written_objects = _read_osm_objects(node_file) + _read_osm_objects(way_file)
+        assert written_objects == [('n', node.id, 1, node.location, {}) for node in nodes] + \
+            [('w', way.id, 1, way.nodes, dict(way.tags)) for way in ways]
+    # keeping the generated objects of the additional plazas would take around 900 kB more
+    assert max(peaks) - peaks[0] < 256 * 1024
+
+
+def test_transform_plaza_node_deduplication():
+    """ with osm-precision, coordinates that are the same in OSM should share a node """
+    plaza = {
+        'graph_edges': [LineString([(0, 0), (1, 1)]), LineString([(1 + 1e-9, 1), (2, 2), (2, 2 + 1e-9)])],
+        'entry_points': [Point(0, 0)],
+        'entry_lines': [{'way_id': 99, 'entry_points': [Point(0, 1e-9)]}]
+    }
+    exact_transformer = plazatransformer.PlazaTransformer(0, 0, {}, node_deduplication='exact')
+    exact_transformer.transform_plaza(plaza)
+    assert len(exact_transformer.nodes) == 6
+
+    plaza_transformer = plazatransformer.PlazaTransformer(0, 0, {}, node_deduplication='osm-precision')
+    plaza_transformer.transform_plaza(plaza)
+    ways = plaza_transformer.output.ways
+    assert len(plaza_transformer.nodes) == 3
+    assert ways[1].nodes[0] == ways[0].nodes[1]
+    assert list(ways[1].nodes) == [ways[0].nodes[1], ways[1].nodes[1]]
+    assert plaza_transformer.entry_node_mappings[99][0]['id'] == ways[0].nodes[0]
+    assert plaza_transformer.entry_node_mappings[99][0]['coords'] == (0, 1e-9)
+
+    with pytest.raises(ValueError):
+        plazatransformer.PlazaTransformer(0, 0, {}, node_deduplication='rounded')
+
+
+def test_fixed_point_key():
+    """ coordinates should be rounded like osmium does """
+    random = np.random.RandomState(0)
+    coords = random.uniform(-180, 180, (1000, 2)).tolist() + [(-1.00000005, 0.00000005), (8.54, -47.37)]
+    for lon, lat in coords:
+        location = Location(lon, lat)
+        expected_key = plazatransformer._fixed_point_key((location.x / 1e7, location.y / 1e7))
+        assert plazatransformer._fixed_point_key((lon, lat)) == expected_key
+        assert plazatransformer._fixed_point_key((lon, lat)) == (location.x << 32) | (location.y & 0xffffffff)
+
+
+@pytest.mark.parametrize('testfile', ['kreuzplatz', pytest.param('bahnhofstrasse', marks=pytest.mark.benchmark)])
+def test_node_deduplication(testfile, config, timed, benchmark_result):
+    """ quantising the coordinates should not create more nodes than exact deduplication """
+    plazas = _process_testfile_plazas(testfile, config)
+    node_counts = []
+    for node_deduplication in ['exact', 'osm-precision']:
+        nodes, ways, _ = timed(node_deduplication, plazatransformer.create_plaza_objects,
+                               plazas, config['footway-tags'], node_deduplication)
+        benchmark_result(f'{node_deduplication} objects', f'{len(nodes)} nodes, {len(ways)} ways')
+        node_counts.append(len(nodes))
+    assert node_counts[1] <= node_counts[0]
+
+
 def test_transform_real_plaza(process_strategy, shortest_path_strategy, config):
     plaza = utils.process_plaza('helvetiaplatz', 4533221, process_strategy, shortest_path_strategy, config)
     assert plaza
 
     plaza_transformer = plazatransformer.PlazaTransformer(0, 0, config['footway-tags'])
     plaza_transformer.transform_plaza(plaza)
-    assert len(plaza_transformer.ways) == len(plaza['graph_edges'])
+    assert len(plaza_transformer.output.ways) == len(plaza['graph_edges'])
     way_id = 259200019  # footway with 2 entry points
     assert way_id in plaza_transformer.entry_node_mappings
     assert len(plaza_transformer.entry_node_mappings[way_id]) == 2
@@ -117,28 +231,27 @@ def test_merge_simple_plaza(process_strategy, shortest_path_strategy, config):
 
 
 def test_find_exact_insert_position():
-    entry_point = Point(2, 2)
+    entry_node = {'id': -1, 'coords': (2, 2)}
     way_nodes = [
         {'id': 1, 'coords': (0, 0)},
         {'id': 2, 'coords': (2, 0)},
         {'id': 3, 'coords': (2, 2)},
         {'id': 4, 'coords': (0, 2)},
     ]
-    pos = merger._find_exact_insert_position(entry_point, way_nodes)
-    assert pos == 2
+    new_way_nodes = merger._insert_entry_node_batch([entry_node], way_nodes)
+    assert new_way_nodes.index(entry_node) == 2
 
 
 def test_find_interpolated_insert_position():
-    entry_point = Point(2.5, 1)
+    entry_node = {'id': -1, 'coords': (2.5, 1)}
     way_nodes = [
         {'id': 1, 'coords': (0, 0)},
         {'id': 2, 'coords': (2, 0)},
         {'id': 3, 'coords': (3, 2)},
         {'id': 4, 'coords': (1, 2)},
     ]
-    pos = merger._find_interpolated_insert_position(
-        entry_point, way_nodes)
-    assert pos == 2
+    new_way_nodes = merger._insert_entry_node_batch([entry_node], way_nodes)
+    assert new_way_nodes.index(entry_node) == 2
 
 
 def test_insert_entry_nodes():
@@ -180,6 +293,185 @@ def test_insert_entry_nodes():
     assert entry_ways == entry_ways_expected
 
 
+def test_stream_merge(config, tmpdir):
+    """ the merged file should be sorted and contain the original and the generated objects """
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    plazas = _process_testfile_plazas('kreuzplatz', config)
+    nodes, ways, entry_node_mappings = plazatransformer.create_plaza_objects(plazas, config['footway-tags'])
+    merged_filename = str(tmpdir.join('merged.osm'))
+    merger.merge_plaza_graphs(plazas, testfile, merged_filename, config['footway-tags'])
+
+    original = _read_osm_objects(testfile)
+    merged = _read_osm_objects(merged_filename)
+    merged_ids = [(osm_type, osm_id) for osm_type, osm_id, *_ in merged]
+    assert merged_ids == sorted(merged_ids, key=lambda key: ('nwr'.index(key[0]), key[1]))
+    assert sorted(merged_ids) == sorted([(osm_type, osm_id) for osm_type, osm_id, *_ in original] +
+                                        [('n', node.id) for node in nodes] + [('w', way.id) for way in ways])
+
+    merged_by_id = {(osm_type, osm_id): rest for osm_type, osm_id, *rest in merged}
+    for osm_type, osm_id, *rest in original:
+        if osm_type == 'w' and osm_id in entry_node_mappings:
+            version, refs, tags = merged_by_id[(osm_type, osm_id)]
+            assert version == rest[0] + 1
+            assert set(refs) == set(rest[1]) | {node['id'] for node in entry_node_mappings[osm_id]}
+            assert tags == rest[2]
+        else:
+            assert merged_by_id[(osm_type, osm_id)] == rest
+
+
+def test_plaza_ways_from_lines(config, monkeypatch):
+    """ the imported lines should give the same ways as reading the file again """
+    testfile = testfilemanager.get_testfile_name('kreuzplatz')
+    holder = testfilemanager.import_testfile('kreuzplatz', config)
+    entry_node_mappings = {line['id']: [] for line in holder.lines}
+
+    extracted_ways = merger._extract_plaza_ways(entry_node_mappings, testfile)
+    plaza_ways = merger._get_plaza_ways(entry_node_mappings, testfile, holder.lines, importer.DEFAULT_LOCATION_INDEX)
+    assert plaza_ways == extracted_ways
+
+    # the lines with entry points intersect a plaza and keep their nodes, the file isn't read again
+    plazas = _process_testfile_plazas('kreuzplatz', config)
+    _, _, entry_node_mappings = plazatransformer.create_plaza_objects(plazas, config['footway-tags'])
+    monkeypatch.setattr(merger, '_extract_plaza_ways', lambda *args: pytest.fail('file read again'))
+    plaza_ways = merger._get_plaza_ways(entry_node_mappings, testfile, holder.lines, importer.DEFAULT_LOCATION_INDEX)
+    assert plaza_ways == {way_id: extracted_ways[way_id] for way_id in entry_node_mappings}
+
+
+@pytest.mark.parametrize('name', ['kreuzplatz', pytest.param('bahnhofstrasse', marks=pytest.mark.benchmark)])
+def test_merge_like_osmosis(name, config, tmpdir, timed):
+    """ the streaming merge should write the same objects as osmosis """
+    if shutil.which('osmosis') is None:
+        pytest.skip('osmosis is not installed')
+    testfile = testfilemanager.get_testfile_name(name)
+    plazas = _process_testfile_plazas(name, config)
+
+    osmosis_filename = str(tmpdir.join(f'{name}-osmosis.osm'))
+    timed('osmosis merge', merger.merge_plaza_graphs, plazas, testfile, osmosis_filename, config['footway-tags'],
+          use_osmosis=True)
+    stream_filename = str(tmpdir.join(f'{name}-stream.osm'))
+    timed('streaming merge', merger.merge_plaza_graphs, plazas, testfile, stream_filename, config['footway-tags'])
+    assert _read_osm_objects(stream_filename) == _read_osm_objects(osmosis_filename)
+
+
+@pytest.mark.parametrize('name', ['kreuzplatz', pytest.param('zuerich_hb', marks=pytest.mark.benchmark)])
+def test_writer_share(name, config, tmpdir, monkeypatch, timed, benchmark_result):
+    """ writing the output should only be a small part of the whole run """
+    testfile = testfilemanager.get_testfile_name(name)
+    holder = timed('import', testfilemanager.import_testfile, name, config)
+    plazas = timed('processing', optimizer.preprocess_plazas, holder, VisibilityGraphProcessor(visibility_delta_m=0.1),
+                   shortest_paths.compute_dijkstra_shortest_paths, config)
+    merged_filename = str(tmpdir.join(f'{name}.osm.pbf'))
+    timed('merge', merger.merge_plaza_graphs, plazas, testfile, merged_filename, config['footway-tags'])
+
+    null_writer = _NullWriter()
+    monkeypatch.setattr(streammerger, 'SimpleWriter', lambda filename: null_writer)
+    timed('merge without writing', merger.merge_plaza_graphs, plazas, testfile, str(tmpdir.join('unwritten.osm')),
+          config['footway-tags'])
+    assert null_writer.object_count == len(_read_osm_objects(merged_filename))
+
+    elapsed_times = timed.elapsed_times
+    writer_time = elapsed_times['merge'] - elapsed_times['merge without writing']
+    total_time = elapsed_times['import'] + elapsed_times['processing'] + elapsed_times['merge']
+    benchmark_result('writer share', f'{utils.format_ms(writer_time)}, {writer_time / total_time:.0%} of the run')
+
+
+class _NullWriter:
+    """ counts the objects instead of writing them """
+    def __init__(self):
+        self.object_count = 0
+
+    def add_node(self, node):
+        self.object_count += 1
+
+    def add_way(self, way):
+        self.object_count += 1
+
+    def add_relation(self, relation):
+        self.object_count += 1
+
+    def close(self):
+        pass
+
+
+def _process_testfile_plazas(name, config):
+    holder = testfilemanager.import_testfile(name, config)
+    return optimizer.preprocess_plazas(
+        holder, VisibilityGraphProcessor(visibility_delta_m=0.1), shortest_paths.compute_dijkstra_shortest_paths,
+        config)
+
+
+def _read_osm_objects(filename):
+    """ returns type, id, version, location or members and tags of all objects in the order of the file """
+    collector = _ObjectCollector()
+    collector.apply_file(filename)
+    return collector.objects
+
+
+class _ObjectCollector(SimpleHandler):
+    def __init__(self):
+        super().__init__()
+        self.objects = []
+
+    def node(self, node):
+        location = (node.location.lon, node.location.lat)
+        self.objects.append(('n', node.id, node.version, location, dict(node.tags)))
+
+    def way(self, way):
+        self.objects.append(('w', way.id, way.version, [n.ref for n in way.nodes], dict(way.tags)))
+
+    def relation(self, relation):
+        members = [(m.type, m.ref, m.role) for m in relation.members]
+        self.objects.append(('r', relation.id, relation.version, members, dict(relation.tags)))
+
+
+@pytest.mark.parametrize('testfile, long_way_length', [
+    ('kreuzplatz', 100), pytest.param('bahnhofstrasse', 1000, marks=pytest.mark.benchmark)])
+def test_batch_entry_node_insertion(testfile, long_way_length, config, timed):
+    """ the batch insertion should insert entry nodes like inserting them one by one """
+    holder = testfilemanager.import_testfile(testfile, config)
+    plazas = _process_testfile_plazas(testfile, config)
+    _, _, entry_node_mappings = plazatransformer.create_plaza_objects(plazas, config['footway-tags'])
+    plaza_ways = merger._plaza_ways_from_lines(entry_node_mappings, holder.lines)
+
+    # a long way with many entry nodes, some of them on way nodes
+    random = np.random.RandomState(0)
+    long_way_coords = np.cumsum(random.uniform(0, 1e-4, (long_way_length, 2)), axis=0).tolist()
+    plaza_ways[-1] = {'nodes': [{'id': i, 'coords': tuple(coords)} for i, coords in enumerate(long_way_coords)]}
+    entry_node_mappings[-1] = [{'id': -i, 'coords': tuple(long_way_coords[i])} for i in range(1, long_way_length, 10)]
+    for i in range(5, long_way_length, 10):
+        start, end = np.array(long_way_coords[i - 1]), np.array(long_way_coords[i])
+        entry_node_mappings[-1].append({'id': -i, 'coords': tuple(start + (end - start) / 3)})
+
+    expected_nodes = timed('one by one', _insert_entry_nodes_one_by_one, plaza_ways, entry_node_mappings)
+    timed('batch', merger._insert_entry_nodes, plaza_ways, entry_node_mappings)
+    for way_id, way_nodes in expected_nodes.items():
+        assert [node['id'] for node in plaza_ways[way_id]['nodes']] == [node['id'] for node in way_nodes]
+
+
+def _insert_entry_nodes_one_by_one(plaza_ways, entry_node_mappings):
+    """ the nodes of every way with its entry nodes inserted one by one, plaza_ways are left unchanged """
+    way_nodes_by_id = {}
+    for way_id, entry_nodes in entry_node_mappings.items():
+        way_nodes = list(plaza_ways[way_id]['nodes'])
+        for entry_node in entry_nodes:
+            way_nodes.insert(_find_insert_position(entry_node, way_nodes), entry_node)
+        way_nodes_by_id[way_id] = way_nodes
+    return way_nodes_by_id
+
+
+def _find_insert_position(entry_node, way_nodes):
+    """
+    position of a single entry node: before the first way node with the same coordinates,
+    otherwise after the start of the first closest segment
+    """
+    coords = [node['coords'] for node in way_nodes]
+    if entry_node['coords'] in coords:
+        return coords.index(entry_node['coords'])
+    entry_point = Point(entry_node['coords'])
+    distances = [LineString(coords[i:i + 2]).distance(entry_point) for i in range(len(coords) - 1)]
+    return distances.index(min(distances)) + 1
+
+
 def create_test_plaza():
     edges = [
         LineString([(0, 0), (1, 1)]),
@@ -2,11 +2,23 @@ import pytest
 import testfilemanager
 import utils
 import os
+import pickle
+import time
+import rtree
+import numpy as np
+from math import ceil
+from shapely.geometry import Point, LineString, Polygon, MultiPolygon, CAP_STYLE, JOIN_STYLE, box
 import plaza_preprocessing.optimizer.optimizer as optimizer
 from plaza_preprocessing.optimizer import shortest_paths
+from plaza_preprocessing.optimizer import utils as optimizer_utils
 from plaza_preprocessing import configuration
+from plaza_preprocessing.importer import importcache
+from plaza_preprocessing.importer.osmholder import OSMHolder
+from plaza_preprocessing.optimizer import plazastate
+from plaza_preprocessing.optimizer.resultcache import PlazaResultCache, plaza_result_key
 from plaza_preprocessing.optimizer.graphprocessor.spiderwebgraph import SpiderWebGraphProcessor
 from plaza_preprocessing.optimizer.graphprocessor.visibilitygraph import VisibilityGraphProcessor
+from plaza_preprocessing.optimizer.graphprocessor.sweepvisibilitygraph import SweepVisibilityGraphProcessor
 
 
 @pytest.fixture(params=['visibility', 'spiderweb'])
@@ -58,6 +70,38 @@ def test_multiple_plazas(process_strategy, shortest_path_strategy, config):
     assert len(set(all_edges)) == len(all_edges)  # check for duplicates
 
 
+def test_parallel_plazas(process_strategy, shortest_path_strategy, config):
+    """ processing with multiple workers should yield the same plazas in the same order """
+    holder = testfilemanager.import_testfile('zentrum_witikon', config)
+    sequential_plazas = optimizer.preprocess_plazas(
+        holder, process_strategy, shortest_path_strategy, config)
+    holder = testfilemanager.import_testfile('zentrum_witikon', config)
+    parallel_plazas = optimizer.preprocess_plazas(
+        holder, process_strategy, shortest_path_strategy, config, workers=2)
+
+    assert [p['osm_id'] for p in parallel_plazas] == [p['osm_id'] for p in sequential_plazas]
+    assert all(
+        [e.coords[:] for e in parallel['graph_edges']] == [e.coords[:] for e in sequential['graph_edges']]
+        for parallel, sequential in zip(parallel_plazas, sequential_plazas))
+
+
+def test_low_memory_import(process_strategy, shortest_path_strategy, config):
+    """
+    dropping geometries outside of the plazas should not change the result
+    (apart from floating point differences, since the obstacles may be cut out in a different order)
+    """
+    holder = testfilemanager.import_testfile('zentrum_witikon', config)
+    plazas = optimizer.preprocess_plazas(holder, process_strategy, shortest_path_strategy, config)
+    holder = testfilemanager.import_testfile('zentrum_witikon', config, low_memory=True)
+    low_memory_plazas = optimizer.preprocess_plazas(holder, process_strategy, shortest_path_strategy, config)
+
+    assert [p['osm_id'] for p in low_memory_plazas] == [p['osm_id'] for p in plazas]
+    assert all(
+        abs(low_memory['geometry'].area - plaza['geometry'].area) < 1e-15 and
+        len(low_memory['entry_points']) == len(plaza['entry_points'])
+        for low_memory, plaza in zip(low_memory_plazas, plazas))
+
+
 def test_optimized_lines_inside_plaza(process_strategy, shortest_path_strategy, config):
     holder = testfilemanager.import_testfile('bahnhofplatz_bern', config)
     plaza = utils.get_plaza_by_id(holder.plazas, 5117701)
@@ -117,3 +161,400 @@ def test_entry_points_with_cutout_polygon(process_strategy, shortest_path_strate
     result_plaza = utils.process_plaza('zuerich_hb', 6605179, process_strategy, shortest_path_strategy, config)
     assert result_plaza
     assert len(result_plaza['entry_points']) == 9
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofplatz_bern', 5117701, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofstrasse', 150139894, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_visibility_checker(testfile, plaza_id, config, timed):
+    """ the visibility checker should find the same visible lines as line_visible """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    coords = list(set(optimizer_utils.get_polygon_coords(plaza_geometry) + [(p.x, p.y) for p in entry_points]))
+    lines = [LineString([start, end]) for i, start in enumerate(coords) for end in coords[i + 1:]]
+
+    expected = timed('intersection', _intersect_lines, plaza_geometry, lines)
+    visible = timed('visibility checker', _check_lines, plaza_geometry, lines)
+    assert visible == expected
+
+
+def _intersect_lines(plaza_geometry, lines):
+    return [optimizer_utils.line_visible(plaza_geometry, line, 0.1) for line in lines]
+
+
+def _check_lines(plaza_geometry, lines):
+    checker = optimizer_utils.VisibilityChecker(plaza_geometry, 0.1)
+    return [checker.line_visible(line) for line in lines]
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofplatz_bern', 5117701, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 6605179, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_sweep_visibility_graph(testfile, plaza_id, config, timed):
+    """ the rotational sweep should find the same edges as the visibility graph """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+
+    expected = timed('visibility', VisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges,
+                     plaza_geometry, entry_points)
+    graph_edges = timed('sweep', SweepVisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges,
+                        plaza_geometry, entry_points)
+    assert len(graph_edges) == len(expected)
+    assert {frozenset(edge.coords) for edge in graph_edges} == {frozenset(edge.coords) for edge in expected}
+
+
+def test_sweep_visibility_graph_collinear():
+    """ lines along the plaza boundary and through aligned vertices should be decided like in the visibility graph """
+    unit = 1e-5
+    plaza_geometry = box(8.5, 47.3, 8.5 + 40 * unit, 47.3 + 30 * unit)
+    for x, y in [(5, 5), (15, 5), (25, 5), (5, 15), (15, 20)]:
+        obstacle = box(8.5 + x * unit, 47.3 + y * unit, 8.5 + (x + 5) * unit, 47.3 + (y + 5) * unit)
+        plaza_geometry = plaza_geometry.difference(obstacle)
+    entry_points = [Point(8.5 + 10 * unit, 47.3), Point(8.5 + 40 * unit, 47.3 + 10 * unit), Point(8.5, 47.3 + 17 * unit)]
+
+    expected = VisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges(plaza_geometry, entry_points)
+    graph_edges = SweepVisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges(plaza_geometry, entry_points)
+    assert {frozenset(edge.coords) for edge in graph_edges} == {frozenset(edge.coords) for edge in expected}
+
+
+def test_sweep_visibility_graph_small_plaza():
+    """ plazas with few vertices are checked pair by pair, with the same result """
+    plaza_geometry = Polygon([(0, 0), (4e-4, 0), (4e-4, 3e-4), (2e-4, 1e-4), (0, 3e-4)])
+    entry_points = [Point(1e-4, 0), Point(4e-4, 2e-4), Point(0, 2e-4)]
+
+    expected = VisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges(plaza_geometry, entry_points)
+    graph_edges = SweepVisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges(plaza_geometry, entry_points)
+    assert {frozenset(edge.coords) for edge in graph_edges} == {frozenset(edge.coords) for edge in expected}
+    assert len(graph_edges) < 28
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_spiderweb_graph(testfile, plaza_id, config, timed):
+    """ the batched spider web graph should have the same edges as checking every grid line """
+    plaza_geometry, _ = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    processor = SpiderWebGraphProcessor(spacing_m=2, visibility_delta_m=0.1)
+
+    expected = timed('per line', _calc_spiderwebgraph_per_line, processor, plaza_geometry)
+    graph_edges = timed('batched', processor._calc_spiderwebgraph, plaza_geometry)
+    assert [edge.coords[:] for edge in graph_edges] == [edge.coords[:] for edge in expected]
+
+
+def _calc_spiderwebgraph_per_line(processor, plaza_geometry):
+    """ spider web graph checking the visibility of each grid line separately """
+    spacing = optimizer_utils.meters_to_degrees(processor.spacing_m)
+    x_left, y_bottom, x_right, y_top = plaza_geometry.bounds
+    rows = int(ceil((y_top - y_bottom) / spacing))
+    columns = int(ceil((x_right - x_left) / spacing))
+
+    graph_edges = []
+    for column in range(0, columns + 1):
+        for row in range(0, rows + 1):
+            x_1 = x_left + (column * spacing)
+            x_2 = x_left + ((column + 1) * spacing)
+            y_1 = y_bottom + (row * spacing)
+            y_2 = y_bottom + ((row + 1) * spacing)
+            lines = []
+            if column < columns:
+                lines.append(LineString([(x_1, y_1), (x_2, y_1)]))
+            if row < rows:
+                lines.append(LineString([(x_1, y_1), (x_1, y_2)]))
+            if row < rows and column < columns:
+                lines.append(LineString([(x_1, y_1), (x_2, y_2)]))
+                lines.append(LineString([(x_1, y_2), (x_2, y_1)]))
+            graph_edges.extend(
+                line for line in lines if optimizer_utils.line_visible(plaza_geometry, line, processor.visibility_delta_m))
+    return graph_edges
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_spiderweb_entry_point_connections(testfile, plaza_id, config, timed):
+    """ entry points should be connected to the nearest node of the graph """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    processor = SpiderWebGraphProcessor(spacing_m=2, visibility_delta_m=0.1)
+    graph_edges = processor._calc_spiderwebgraph(plaza_geometry)
+    nodes = {coords for edge in graph_edges for coords in edge.coords}
+
+    connection_lines = timed('index', processor._connect_entry_points_with_graph,
+                             entry_points, list(graph_edges))[len(graph_edges):]
+    expected_lengths = timed('linear search', _nearest_node_distances, entry_points, nodes)
+    assert len(connection_lines) == len(entry_points)
+    assert [line.length for line in connection_lines] == pytest.approx(expected_lengths)
+
+
+def _nearest_node_distances(entry_points, nodes):
+    return [min(entry_point.distance(Point(node)) for node in nodes) for entry_point in entry_points]
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofstrasse', 150139894, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofstrasse', 43583464, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_obstacle_union(testfile, plaza_id, config, timed):
+    """ cutting out the union of all obstacles should give the same plaza as cutting them out one by one """
+    holder = testfilemanager.import_testfile(testfile, config)
+    plaza = utils.get_plaza_by_id(holder.plazas, plaza_id)
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    intersecting_lines = processor._find_intersecting_lines(plaza['geometry'])
+    buffer_m = config['obstacle-buffer']
+
+    expected = timed('one by one', _cut_out_obstacles_one_by_one, processor, plaza, intersecting_lines, buffer_m)
+    geometry = timed('union', processor._calc_obstacle_geometry, plaza, intersecting_lines, buffer_m)
+    timed.speedup('one by one', 'union')
+    if isinstance(expected, MultiPolygon):
+        expected = max(expected, key=lambda p: p.area)
+    assert geometry.symmetric_difference(expected).area < expected.area * 1e-9
+
+
+@pytest.mark.parametrize('obstacle_count', [50, pytest.param(1000, marks=pytest.mark.benchmark)])
+def test_obstacle_union_many_obstacles(obstacle_count, config, timed):
+    """ the union pays off with many obstacles, which the test files don't have """
+    random = np.random.RandomState(0)
+    corners = random.uniform(0, 1e-2, (obstacle_count, 2))
+    buildings = [box(x, y, x + 1e-4, y + 1e-4) for x, y in corners]
+    plaza = {'osm_id': 1, 'geometry': box(0, 0, 1e-2, 1e-2)}
+    holder = OSMHolder([plaza], buildings, [], [])
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    buffer_m = config['obstacle-buffer']
+
+    expected = timed('one by one', _cut_out_obstacles_one_by_one, processor, plaza, [], buffer_m)
+    geometry = timed('union', processor._calc_obstacle_geometry, plaza, [], buffer_m)
+    timed.speedup('one by one', 'union')
+    assert geometry.symmetric_difference(expected).area < expected.area * 1e-9
+
+
+def _cut_out_obstacles_one_by_one(processor, plaza, intersecting_lines, buffer_m):
+    obstacles = processor._find_intersecting_buildings(plaza['geometry'])
+    obstacles += [processor._create_point_obstacle(p, buffer_m)
+                  for p in processor._get_points_inside_plaza(plaza['geometry'])]
+    obstacles += processor._create_barrier_obstacles(intersecting_lines, buffer_m / 2)
+    assert obstacles
+    geometry = plaza['geometry']
+    for obstacle in obstacles:
+        geometry = geometry.difference(obstacle)
+    return geometry
+
+
+def test_points_in_polygon():
+    polygon = box(0, 0, 4, 4).difference(box(1, 1, 3, 3))
+    multipolygon = MultiPolygon([polygon, box(5, 0, 6, 1)])
+    coords = [(0.5, 0.5), (2, 2), (3.5, 2), (5.5, 0.5), (7, 0.5), (-1, 2)]
+    assert optimizer_utils.points_in_polygon(polygon, coords).tolist() == [True, False, True, False, False, False]
+    assert optimizer_utils.points_in_polygon(multipolygon, coords).tolist() == [True, False, True, True, False, False]
+    assert optimizer_utils.points_in_polygon(polygon, []).tolist() == []
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofplatz_bern', 5117701, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_batched_entry_points(testfile, plaza_id, config, timed):
+    """ checking all points against the buffer at once should find the same entry points as checking them one by one """
+    holder = testfilemanager.import_testfile(testfile, config)
+    plaza = utils.get_plaza_by_id(holder.plazas, plaza_id)
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    intersecting_lines = processor._find_intersecting_lines(plaza['geometry'])
+    plaza_geometry = processor._calc_obstacle_geometry(plaza, intersecting_lines, config['obstacle-buffer'])
+    lookup_buffer_m = config['entry-point-lookup-buffer']
+
+    expected = timed('one by one', _calc_entry_points_one_by_one, plaza_geometry, intersecting_lines, lookup_buffer_m)
+    entry_points = timed('batched', processor._calc_entry_points, plaza_geometry, intersecting_lines, lookup_buffer_m)
+    assert entry_points
+    assert {(p.x, p.y) for p in entry_points} == {(p.x, p.y) for p in expected}
+
+
+def _calc_entry_points_one_by_one(plaza_geometry, intersecting_lines, lookup_buffer_m):
+    intersection_coords = set()
+    for line in intersecting_lines:
+        intersection = line['geometry'].intersection(plaza_geometry)
+        intersection_coords = intersection_coords.union(optimizer_utils.unpack_geometry_coordinates(intersection))
+    plaza_outer_buffer = plaza_geometry.exterior.buffer(
+        optimizer_utils.meters_to_degrees(lookup_buffer_m), cap_style=CAP_STYLE.flat, join_style=JOIN_STYLE.mitre)
+    return [p for p in map(Point, intersection_coords) if plaza_outer_buffer.contains(p)]
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofplatz_bern', 5117701, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_map_entry_lines(testfile, plaza_id, config, timed):
+    """ the coordinate index should map the same entry points to the lines as searching the line coordinates """
+    holder = testfilemanager.import_testfile(testfile, config)
+    plaza = utils.get_plaza_by_id(holder.plazas, plaza_id)
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    intersecting_lines = processor._find_intersecting_lines(plaza['geometry'])
+    _, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+
+    expected = timed('search', _map_entry_lines_by_search, intersecting_lines, entry_points)
+    entry_lines = timed('index', processor._map_entry_lines, intersecting_lines, entry_points)
+    assert entry_lines
+    assert entry_lines == expected
+
+
+def _map_entry_lines_by_search(intersecting_lines, entry_points):
+    entry_lines = []
+    for line in intersecting_lines:
+        matching_entry_points = [p for p in entry_points if (p.x, p.y) in line['geometry'].coords]
+        if matching_entry_points:
+            entry_lines.append({'way_id': line['id'], 'entry_points': matching_entry_points})
+    return entry_lines
+
+
+@pytest.mark.parametrize('testfile', ['kreuzplatz', pytest.param('bahnhofstrasse', marks=pytest.mark.benchmark)])
+def test_bulk_loaded_spatial_index(testfile, config, timed):
+    """ the bulk loaded index and the bulk query should find the same geometries as inserting one by one """
+    holder = testfilemanager.import_testfile(testfile, config)
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    line_geometries = [line['geometry'] for line in holder.lines]
+
+    expected_index = timed('inserting', _create_spatial_index_one_by_one, line_geometries)
+    index = timed('bulk loading', processor._create_spatial_index, line_geometries)
+
+    plaza_bounds = [plaza['geometry'].bounds for plaza in holder.plazas]
+    expected = [sorted(expected_index.intersection(bounds)) for bounds in plaza_bounds]
+    assert processor._search_index_bulk(index, plaza_bounds) == expected
+    assert [sorted(index.intersection(bounds)) for bounds in plaza_bounds] == expected
+    for plaza in holder.plazas:
+        assert processor._find_intersecting_lines(plaza['geometry']) == [
+            line for line in holder.lines if plaza['geometry'].intersects(line['geometry'])]
+
+
+def _create_spatial_index_one_by_one(geometries):
+    index = rtree.index.Index()
+    for i, geometry in enumerate(geometries):
+        index.insert(i, geometry.bounds)
+    return index
+
+
+def test_cached_import(process_strategy, shortest_path_strategy, config, tmpdir):
+    """ plazas should be processed the same with the cached holder and its disk index """
+    filename = testfilemanager.get_testfile_name('kreuzplatz')
+    holder = testfilemanager.import_testfile('kreuzplatz', config)
+    importcache.import_osm_cached(filename, config['tag-filter'], str(tmpdir))
+    cached_holder = importcache.import_osm_cached(filename, config['tag-filter'], str(tmpdir))
+
+    plaza = utils.get_plaza_by_id(holder.plazas, 5541230)
+    cached_plaza = utils.get_plaza_by_id(cached_holder.plazas, 5541230)
+    result = optimizer.PlazaPreprocessor(
+        holder, process_strategy, shortest_path_strategy, config)._process_plaza(plaza)
+    cached_result = optimizer.PlazaPreprocessor(
+        cached_holder, process_strategy, shortest_path_strategy, config)._process_plaza(cached_plaza)
+
+    assert cached_result['geometry'].equals(result['geometry'])
+    assert len(cached_result['entry_points']) == len(result['entry_points'])
+    assert len(cached_result['graph_edges']) == len(result['graph_edges'])
+
+
+def test_preprocess_changed_plazas(config, tmpdir):
+    """ only plazas intersecting the changed bounds should be processed again """
+    process_strategy = VisibilityGraphProcessor(visibility_delta_m=0.1)
+    shortest_path_strategy = shortest_paths.compute_dijkstra_shortest_paths
+    holder = testfilemanager.import_testfile('europaallee', config)
+    results = optimizer.preprocess_changed_plazas(
+        holder, process_strategy, shortest_path_strategy, config, {}, [])
+    assert len(results) == len(holder.plazas)
+
+    state_file = str(tmpdir.join('plazas.state'))
+    plazastate.save_state(state_file, results)
+    previous_results = plazastate.load_state(state_file)
+
+    holder = testfilemanager.import_testfile('europaallee', config)
+    changed_point = utils.get_plaza_by_id(holder.plazas, 31824220)['geometry'].representative_point()
+    changed_bounds = [changed_point.bounds]
+    expected_changed = [plazastate.plaza_key(plaza) for plaza in holder.plazas
+                        if box(*plaza['geometry'].bounds).intersects(changed_point)]
+    new_results = optimizer.preprocess_changed_plazas(
+        holder, process_strategy, shortest_path_strategy, config, previous_results, changed_bounds)
+
+    assert list(new_results) == list(previous_results)
+    assert [key for key in new_results if new_results[key] is not previous_results[key]] == expected_changed
+    changed_result = new_results[expected_changed[0]]
+    assert len(changed_result['graph_edges']) == len(previous_results[expected_changed[0]]['graph_edges'])
+
+
+def test_result_cache(config, tmpdir, monkeypatch):
+    """ the second run should take all results from the cache and return the same plazas """
+    process_strategy = VisibilityGraphProcessor(visibility_delta_m=0.1)
+    shortest_path_strategy = shortest_paths.compute_dijkstra_shortest_paths
+    result_cache = PlazaResultCache(str(tmpdir), 100 * 1024 * 1024)
+
+    holder = testfilemanager.import_testfile('europaallee', config)
+    results = optimizer.process_plaza_results(
+        holder, process_strategy, shortest_path_strategy, config, result_cache=result_cache)
+
+    def fail_processing(*args):
+        raise AssertionError('plaza was processed although its result is cached')
+    monkeypatch.setattr(optimizer.PlazaPreprocessor, '_process_plaza_with_geometries', fail_processing)
+    holder = testfilemanager.import_testfile('europaallee', config)
+    cached_results = optimizer.process_plaza_results(
+        holder, process_strategy, shortest_path_strategy, config, result_cache=result_cache)
+
+    assert [result is None for result in cached_results] == [result is None for result in results]
+    for result, cached_result in zip(results, cached_results):
+        if result is not None:
+            assert cached_result['geometry'].equals(result['geometry'])
+            assert cached_result['entry_points'] == result['entry_points']
+            assert [line.coords[:] for line in cached_result['graph_edges']] == \
+                [line.coords[:] for line in result['graph_edges']]
+
+
+def test_result_cache_parallel(config, tmpdir):
+    """ with several workers, the results should be stored by the main process, within the size of the cache """
+    process_strategy = VisibilityGraphProcessor(visibility_delta_m=0.1)
+    shortest_path_strategy = shortest_paths.compute_dijkstra_shortest_paths
+    holder = testfilemanager.import_testfile('europaallee', config)
+    result_cache = PlazaResultCache(str(tmpdir.join('unbounded')), 100 * 1024 * 1024)
+    optimizer.process_plaza_results(
+        holder, process_strategy, shortest_path_strategy, config, workers=2, result_cache=result_cache)
+    entry_sizes = [entry.stat().st_size for entry in os.scandir(result_cache.cache_dir)]
+    assert len(entry_sizes) == len(holder.plazas)
+    assert result_cache.size_bytes == sum(entry_sizes)
+
+    max_size_bytes = sum(entry_sizes) // 2
+    bounded_cache = PlazaResultCache(str(tmpdir.join('bounded')), max_size_bytes)
+    holder = testfilemanager.import_testfile('europaallee', config)
+    optimizer.process_plaza_results(
+        holder, process_strategy, shortest_path_strategy, config, workers=2, result_cache=bounded_cache)
+    assert sum(entry.stat().st_size for entry in os.scandir(bounded_cache.cache_dir)) <= max_size_bytes
+
+
+def test_result_cache_key(config):
+    """ the key should change with every config value except the footway tags """
+    holder = testfilemanager.import_testfile('kreuzplatz', config)
+    plaza = holder.plazas[0]
+    key = plaza_result_key(plaza, holder.lines, holder.buildings, holder.points, config)
+    assert plaza_result_key(plaza, holder.lines, holder.buildings, holder.points, dict(config)) == key
+    assert plaza_result_key(plaza, holder.lines, holder.buildings, holder.points,
+                            {**config, 'footway-tags': {}}) == key
+    assert plaza_result_key(plaza, holder.lines, holder.buildings, holder.points,
+                            {**config, 'obstacle-buffer': config['obstacle-buffer'] + 1}) != key
+    assert plaza_result_key(plaza, holder.lines[1:], holder.buildings, holder.points, config) != key
+
+
+def test_result_cache_eviction(tmpdir):
+    """ the least recently used results should be removed when the cache is full """
+    entry_size = len(pickle.dumps(b'x' * 1000, pickle.HIGHEST_PROTOCOL))
+    result_cache = PlazaResultCache(str(tmpdir), 3 * entry_size)
+    for key in ['a', 'b', 'c']:
+        result_cache.put(key, b'x' * 1000)
+        # mtime resolution can be coarse
+        time.sleep(0.01)
+    assert result_cache.get('a') == (True, b'x' * 1000)
+    time.sleep(0.01)
+    result_cache.put('d', b'x' * 1000)
+
+    assert result_cache.get('b') == (False, None)
+    assert all(result_cache.get(key)[0] for key in ['a', 'c', 'd'])
+    assert result_cache.size_bytes <= 3 * entry_size
@@ -1,5 +1,18 @@
+import pytest
+import os
+import utils
 from shapely.geometry import LineString, Point
+from plaza_preprocessing import configuration
 from plaza_preprocessing.optimizer import shortest_paths
+from plaza_preprocessing.optimizer.graphprocessor.spiderwebgraph import SpiderWebGraphProcessor
+from plaza_preprocessing.optimizer.graphprocessor.visibilitygraph import VisibilityGraphProcessor
+
+
+@pytest.fixture
+def config():
+    config_path = 'testconfig.yml'
+    yield configuration.load_config(config_path)
+    os.remove(config_path)
 
 
 def test_create_graph_simple_edges():
@@ -40,3 +53,151 @@ def test_compute_astar_shortest_paths():
     graph = shortest_paths.create_graph(graph_edges)
     lines = shortest_paths.compute_dijkstra_shortest_paths(graph, entry_points)
     assert expected_lines == [list(line.coords) for line in lines]
+
+
+def test_compute_entry_point_dijkstra_shortest_paths():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(0, 1), (1, 1)]),
+                   LineString([(1, 1), (1, 0)]), LineString([(0, 0), (1, 0)]),
+                   LineString([(0, 0), (1, 1)]), LineString([(1, 1), (2, 1)])]
+
+    entry_points = [Point((0, 0)), Point((2, 1)), Point((1, 0))]
+    expected_lines = [[(0, 0), (1, 1), (2, 1)], [(0, 0), (1, 0)], [(1, 0), (1, 1), (2, 1)]]
+
+    graph = shortest_paths.create_graph(graph_edges)
+    lines = shortest_paths.compute_entry_point_dijkstra_shortest_paths(graph, entry_points)
+    assert expected_lines == [list(line.coords) for line in lines]
+
+
+def test_compute_entry_point_dijkstra_unreachable():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(2, 0), (2, 1)])]
+
+    entry_points = [Point((0, 0)), Point((0, 1)), Point((2, 1)), Point((5, 5))]
+
+    graph = shortest_paths.create_graph(graph_edges)
+    lines = shortest_paths.compute_entry_point_dijkstra_shortest_paths(graph, entry_points)
+    assert [[(0, 0), (0, 1)]] == [list(line.coords) for line in lines]
+
+
+@pytest.mark.parametrize('testfile, plaza_id, spacing_m', [
+    ('kreuzplatz', 5541230, 5),
+    pytest.param('kreuzplatz', 5541230, 2, marks=pytest.mark.benchmark),
+    pytest.param('bahnhofstrasse', 27405455, 5, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, 5, marks=pytest.mark.benchmark)])
+def test_entry_point_dijkstra(testfile, plaza_id, spacing_m, config, timed):
+    """ searching only from the entry points should find paths as short as all pairs dijkstra """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    processor = SpiderWebGraphProcessor(spacing_m=spacing_m, visibility_delta_m=0.1)
+    graph = shortest_paths.create_graph(processor.create_graph_edges(plaza_geometry, entry_points))
+
+    expected = timed('all pairs', shortest_paths.compute_dijkstra_shortest_paths, graph, entry_points)
+    lines = timed('from entry points', shortest_paths.compute_entry_point_dijkstra_shortest_paths, graph, entry_points)
+    assert [(line.coords[0], line.coords[-1]) for line in lines] == \
+        [(line.coords[0], line.coords[-1]) for line in expected]
+    assert [_path_weight(graph, line) for line in lines] == \
+        pytest.approx([_path_weight(graph, line) for line in expected])
+
+
+def _path_weight(graph, line):
+    return sum(graph.edges[start, end]['weight'] for start, end in zip(line.coords, line.coords[1:]))
+
+
+def test_create_array_graph():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(0, 1), (1, 1)]),
+                   LineString([(1, 1), (1, 0)]), LineString([(0, 0), (1, 1)]), LineString([(1, 1), (0, 1)])]
+
+    graph = shortest_paths.create_array_graph(graph_edges)
+
+    assert graph.number_of_nodes() == 4
+    assert graph.adjacency.nnz == 8
+    start_id = graph.node_ids[(0, 0)]
+    end_id = graph.node_ids[(1, 1)]
+    assert graph.adjacency[start_id, end_id] == pytest.approx(2 ** 0.5)
+    assert graph.adjacency[end_id, start_id] == pytest.approx(2 ** 0.5)
+
+
+def test_compute_sparse_dijkstra_shortest_paths():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(0, 1), (1, 1)]),
+                   LineString([(1, 1), (1, 0)]), LineString([(0, 0), (1, 0)]),
+                   LineString([(0, 0), (1, 1)]), LineString([(1, 1), (2, 1)])]
+
+    entry_points = [Point((0, 0)), Point((2, 1)), Point((1, 0))]
+    expected_lines = [[(0, 0), (1, 1), (2, 1)], [(0, 0), (1, 0)], [(1, 0), (1, 1), (2, 1)]]
+
+    graph = shortest_paths.create_array_graph(graph_edges)
+    lines = shortest_paths.compute_sparse_dijkstra_shortest_paths(graph, entry_points)
+    assert expected_lines == [list(line.coords) for line in lines]
+
+
+def test_compute_sparse_dijkstra_unreachable():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(2, 0), (2, 1)])]
+
+    entry_points = [Point((0, 0)), Point((0, 1)), Point((2, 1)), Point((5, 5))]
+
+    graph = shortest_paths.create_array_graph(graph_edges)
+    lines = shortest_paths.compute_sparse_dijkstra_shortest_paths(graph, entry_points)
+    assert [[(0, 0), (0, 1)]] == [list(line.coords) for line in lines]
+
+
+@pytest.mark.parametrize('testfile, plaza_id', [
+    ('kreuzplatz', 5541230),
+    pytest.param('bahnhofstrasse', 27405455, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, marks=pytest.mark.benchmark)])
+def test_sparse_dijkstra(testfile, plaza_id, config, timed):
+    """ the array backed graph should find paths as short as the networkx graph on dense visibility graphs """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    graph_edges = VisibilityGraphProcessor(visibility_delta_m=0.1).create_graph_edges(plaza_geometry, entry_points)
+
+    graph = shortest_paths.create_graph(graph_edges)
+    expected = timed('networkx', _networkx_shortest_paths, graph_edges, entry_points)
+    lines = timed('sparse', _sparse_shortest_paths, graph_edges, entry_points)
+    assert [(line.coords[0], line.coords[-1]) for line in lines] == \
+        [(line.coords[0], line.coords[-1]) for line in expected]
+    assert [_path_weight(graph, line) for line in lines] == \
+        pytest.approx([_path_weight(graph, line) for line in expected])
+
+
+def _networkx_shortest_paths(graph_edges, entry_points):
+    graph = shortest_paths.create_graph(graph_edges)
+    return shortest_paths.compute_entry_point_dijkstra_shortest_paths(graph, entry_points)
+
+
+def _sparse_shortest_paths(graph_edges, entry_points):
+    array_graph = shortest_paths.create_array_graph(graph_edges)
+    return shortest_paths.compute_sparse_dijkstra_shortest_paths(array_graph, entry_points)
+
+
+def test_compute_shared_astar_shortest_paths():
+    graph_edges = [LineString([(0, 0), (0, 1)]), LineString([(0, 1), (1, 1)]),
+                   LineString([(1, 1), (1, 0)]), LineString([(0, 0), (1, 0)]),
+                   LineString([(0, 0), (1, 1)]), LineString([(1, 1), (2, 1)])]
+
+    entry_points = [Point((0, 0)), Point((2, 1)), Point((1, 0))]
+    expected_lines = [[(0, 0), (1, 1), (2, 1)], [(0, 0), (1, 0)], [(1, 0), (1, 1), (2, 1)]]
+
+    graph = shortest_paths.create_graph(graph_edges)
+    lines = shortest_paths.compute_shared_astar_shortest_paths(graph, entry_points)
+    assert expected_lines == [list(line.coords) for line in lines]
+
+
+@pytest.mark.parametrize('testfile, plaza_id, entry_point_count', [
+    ('kreuzplatz', 5541230, 5),
+    pytest.param('zuerich_hb', 5832398, 5, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, 10, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, 20, marks=pytest.mark.benchmark),
+    pytest.param('zuerich_hb', 5832398, 40, marks=pytest.mark.benchmark)])
+def test_shared_astar(testfile, plaza_id, entry_point_count, config, timed):
+    """
+    sharing the search state per entry point should find paths as short as pairwise astar,
+    it should pay off more the more entry points there are
+    """
+    plaza_geometry, entry_points = utils.get_plaza_without_obstacles(testfile, plaza_id, config)
+    entry_points = entry_points[:entry_point_count]
+    processor = SpiderWebGraphProcessor(spacing_m=2, visibility_delta_m=0.1)
+    graph = shortest_paths.create_graph(processor.create_graph_edges(plaza_geometry, entry_points))
+
+    expected = timed('pairwise astar', shortest_paths.compute_astar_shortest_paths, graph, entry_points)
+    lines = timed('shared astar', shortest_paths.compute_shared_astar_shortest_paths, graph, entry_points)
+    assert [(line.coords[0], line.coords[-1]) for line in lines] == \
+        [(line.coords[0], line.coords[-1]) for line in expected]
+    assert [_path_weight(graph, line) for line in lines] == \
+        pytest.approx([_path_weight(graph, line) for line in expected])
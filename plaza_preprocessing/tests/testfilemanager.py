@@ -23,6 +23,6 @@ def get_testfile_name(name):
     return os.path.join(TESTFILEPATH, TEST_PLAZAS[name])
 
 
-def import_testfile(name, config):
+def import_testfile(name, config, low_memory=False):
     filename = get_testfile_name(name)
-    return importer.import_osm(filename, config['tag-filter'])
+    return importer.import_osm(filename, config['tag-filter'], low_memory=low_memory)
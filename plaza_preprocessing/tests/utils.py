@@ -1,3 +1,5 @@
+import time
+import tracemalloc
 import testfilemanager
 from plaza_preprocessing.optimizer import optimizer
 
@@ -14,3 +16,37 @@ def get_plaza_by_id(plazas, osm_id):
     plaza = list(filter(lambda p: p['osm_id'] == osm_id, plazas))
     assert len(plaza) == 1
     return plaza[0]
+
+
+def get_plaza_without_obstacles(testfile, plaza_id, config):
+    """ returns the plaza geometry with obstacles cut out and its entry points """
+    holder = testfilemanager.import_testfile(testfile, config)
+    plaza = get_plaza_by_id(holder.plazas, plaza_id)
+
+    processor = optimizer.PlazaPreprocessor(holder, None, None, config)
+    intersecting_lines = processor._find_intersecting_lines(plaza['geometry'])
+    plaza_geometry = processor._calc_obstacle_geometry(plaza, intersecting_lines, config['obstacle-buffer'])
+    entry_points = processor._calc_entry_points(
+        plaza_geometry, intersecting_lines, config['entry-point-lookup-buffer'])
+    return plaza_geometry, entry_points
+
+
+def call_timed(function, *args, **kwargs):
+    """ returns the result of function(*args, **kwargs) and its run time in seconds """
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def call_traced(function, *args, **kwargs):
+    """ returns the result of function(*args, **kwargs) and the peak of the memory traced while it ran in bytes """
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def format_ms(seconds):
+    return f'{seconds * 1000:.0f} ms'